@@ -0,0 +1,123 @@
+"""
+Check that importing the geothermics package and its modules stays cheap.
+
+Each import is timed in a fresh interpreter (best of a few repeats). numpy is
+imported before timing the modules that need it, so the budgets are for the
+package's own cost. Also checks that the imports don't load the compiled
+extension, plotting or multiprocessing.
+
+Exits with status 1 if any import is over its budget.
+
+Usage: python benchmarks/import_time.py [--repeat N] [--scale FACTOR]
+"""
+
+import os
+import sys
+import optparse
+import subprocess
+
+
+# Module, modules imported before timing, budget [ms]
+budgets = [('geothermics', [], 5.),
+           ('geothermics.diffusionfd1d', ['numpy'], 20.),
+           ('geothermics.subcrust', ['numpy'], 20.),
+           ('geothermics.catalogue', ['numpy'], 20.),
+           ('geothermics.adjoint1d', ['numpy'], 20.),
+           ('geothermics.jobserver', ['numpy'], 50.)]
+
+# Modules that shouldn't be loaded by the imports
+forbidden = ['geothermics._diffusionfd', 'pylab', 'matplotlib']
+
+# The job server needs multiprocessing, the others only on demand
+forbidden_except = {'numpy':['geothermics'],
+                    'multiprocessing':['geothermics.diffusionfd1d',
+                                       'geothermics.subcrust',
+                                       'geothermics.catalogue',
+                                       'geothermics.adjoint1d']}
+
+timer = """
+import sys, timeit
+%s
+start = timeit.default_timer()
+import %s
+print 1000*(timeit.default_timer() - start)
+print ' '.join(sorted(sys.modules))
+"""
+
+
+def measure(module, preload):
+    """
+    Time the import of *module* in a new interpreter.
+
+    Returns [milliseconds, loaded modules]
+    """
+
+    code = timer % ('\n'.join('import %s' % (name) for name in preload),
+                    module)
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    env = dict(os.environ)
+
+    env['PYTHONPATH'] = os.pathsep.join([root, env.get('PYTHONPATH', '')])
+
+    output = subprocess.Popen([sys.executable, '-c', code], env=env,
+                              stdout=subprocess.PIPE).communicate()[0]
+
+    lines = output.splitlines()
+
+    return [float(lines[0]), set(lines[1].split())]
+
+
+def main():
+
+    parser = optparse.OptionParser(usage=__doc__.strip().splitlines()[-1])
+
+    parser.add_option('--repeat', type='int', default=5,
+                      help="number of times each import is timed")
+
+    parser.add_option('--scale', type='float', default=1.,
+                      help="multiply the budgets (for slow machines)")
+
+    options, args = parser.parse_args()
+
+    failed = False
+
+    for module, preload, budget in budgets:
+
+        runs = [measure(module, preload) for i in xrange(options.repeat)]
+
+        elapsed = min(run[0] for run in runs)
+
+        loaded = runs[0][1]
+
+        budget = options.scale*budget
+
+        problems = []
+
+        if elapsed > budget:
+
+            problems.append("over budget")
+
+        bad = [name for name in forbidden if name in loaded]
+
+        bad.extend(name for name, modules in forbidden_except.iteritems()
+                   if module in modules and name in loaded)
+
+        if bad:
+
+            problems.append("loads %s" % (', '.join(bad)))
+
+        failed = failed or bool(problems)
+
+        print "%-28s %7.2f ms (budget %6.2f ms) %s" % (module, elapsed, budget,
+            ('FAIL: ' + '; '.join(problems)) if problems else 'ok')
+
+    if failed:
+
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+
+    main()
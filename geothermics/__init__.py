@@ -1,4 +1,9 @@
 """
 Heat diffusion equation modelling.
+
+The submodules are not imported with the package (import the ones you need,
+e.g. ``from geothermics import diffusionfd1d``) and the compiled extension is
+only loaded when a solver first runs. This keeps ``import geothermics`` cheap
+for short-lived batch jobs. See benchmarks/import_time.py.
 """
-__author__ = 'Leonardo Uieda <leouieda@gmail.com>'
\ No newline at end of file
+__author__ = 'Leonardo Uieda <leouieda@gmail.com>'
@@ -0,0 +1,295 @@
+# Copyright 2010 Leonardo Uieda
+#
+# This file is part of Geothermics.
+#
+# Fatiando a Terra is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Geothermics is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Geothermics.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Inversion of transient temperature data for the thermal diffusivity and
+initial temperature of the 1D Finite Differences (FD) heat diffusion
+simulation, using the discrete adjoint of 'diffusionfd1d.run'
+"""
+__author__ = 'Leonardo Uieda <leouieda@gmail.com>'
+
+
+import math
+
+import numpy
+
+from geothermics import diffusionfd1d
+
+
+def misfit_gradient(deltax, deltat, diffusivity, initial, start_bc, end_bc,
+                    ntimes, obs_steps, obs_nodes, data, error=1.,
+                    checkpoint=None):
+    """
+    Calculate the data misfit of a 'diffusionfd1d.run' and its gradient with
+    respect to the diffusivity and initial temperature.
+
+    The gradient is calculated with the discrete adjoint of the time steps.
+    Only the temperatures at every *checkpoint* steps are kept from the
+    forward run. The others are recalculated one segment at a time during the
+    backward run. The forward run, the recalculation and the adjoint steps
+    all run in compiled code, so the gradient costs about four compiled runs
+    whatever the number of nodes, and the memory is proportional to
+    ntimes/checkpoint + checkpoint temperature arrays.
+
+    Parameters:
+
+      deltax: spacing between the nodes or, for non-uniform grids, 1D
+              array-like with the coordinates of the nodes
+
+      deltat: time step
+
+      diffusivity: 1D array-like thermal diffusivity on each FD node
+
+      initial: 1D array-like temperature on each FD node
+
+      start_bc: boundary condition at the starting point (any built-in one)
+
+      end_bc: boundary condition at the ending point (any built-in one)
+
+      ntimes: number of time steps to run
+
+      obs_steps: strictly increasing list of the time steps with observed
+                 data (0 is the initial temperature)
+
+      obs_nodes: list of the FD nodes with observed data
+
+      data: 2D array-like with the observed temperature at each of
+            *obs_steps* (rows) and *obs_nodes* (columns)
+
+      error: standard deviation of the data
+
+      checkpoint: number of steps between stored temperatures. Defaults to
+                  the square root of *ntimes*.
+
+    Returns:
+
+      [misfit, grad_diffusivity, grad_initial]: half the sum of the squared
+        residuals divided by the error squared and its gradient
+    """
+
+    for bc in [start_bc, end_bc]:
+
+        if not hasattr(bc, 'kind'):
+
+            raise ValueError("Boundary conditions must be built-in")
+
+    diffusionfd1d._check_sides(start_bc, end_bc)
+
+    if checkpoint is None:
+
+        checkpoint = max(1, int(math.sqrt(ntimes)))
+
+    diffusivity = numpy.asarray(diffusivity, dtype='f8')
+
+    nodes = len(diffusivity)
+
+    if numpy.ndim(deltax) == 0:
+
+        spacing, coordinates = deltax, numpy.zeros(nodes)
+
+    else:
+
+        spacing, coordinates = 0., numpy.asarray(deltax, dtype='f8')
+
+    obs_steps = numpy.asarray(obs_steps, dtype='i4')
+
+    if len(obs_steps) and (obs_steps[0] < 0 or
+                           (numpy.diff(obs_steps) <= 0).any()):
+
+        raise ValueError("obs_steps must be increasing and non-negative")
+
+    if not len(obs_steps):
+
+        return [0., numpy.zeros(nodes), numpy.zeros(nodes)]
+
+    # The compiled code counts the nodes from 1
+    obs_nodes = numpy.arange(nodes)[obs_nodes] + 1
+
+    data = numpy.asarray(data, dtype='f8').reshape((len(obs_steps),
+                                                    len(obs_nodes)))
+
+    codes = diffusionfd1d._bc_codes
+
+    misfit, grad_diffusivity, grad_initial = diffusionfd1d._fortran(
+        'misfitgrad1d')(initial, diffusivity, deltat, spacing, coordinates,
+                        ntimes, checkpoint, codes[start_bc.kind],
+                        start_bc.knots[0], start_bc.knots[1],
+                        codes[end_bc.kind], end_bc.knots[0], end_bc.knots[1],
+                        obs_steps, obs_nodes, data.T, error)
+
+    return [misfit, grad_diffusivity, grad_initial]
+
+
+def invert(deltax, deltat, diffusivity, initial, start_bc, end_bc, ntimes,
+           obs_steps, obs_nodes, data, error=1., estimate_initial=False,
+           max_it=50, memory=5, checkpoint=None):
+    """
+    Invert transient temperature data for the diffusivity (and optionally the
+    initial temperature) of a 'diffusionfd1d.run'.
+
+    Uses a limited memory BFGS method with the gradients from
+    'misfit_gradient'. The diffusivity is kept positive and below the
+    stability limit of the explicit time steps.
+
+    Parameters:
+
+      diffusivity: initial estimate of the diffusivity on each FD node
+
+      initial: initial temperature (or its initial estimate if
+               *estimate_initial*)
+
+      estimate_initial: if True, also estimate the initial temperature
+
+      max_it: maximum iterations
+
+      memory: number of previous iterations used to approximate the Hessian
+
+      The other parameters are the same as 'misfit_gradient'.
+
+    Returns:
+
+      [diffusivity, initial, goals]: the estimates and the misfit per
+        iteration
+    """
+
+    nodes = len(diffusivity)
+
+    def unpack(params):
+
+        if estimate_initial:
+
+            return params[:nodes], params[nodes:]
+
+        return params, initial
+
+    def evaluate(params):
+
+        diffusivity, temps = unpack(params)
+
+        misfit, grad_diffusivity, grad_initial = misfit_gradient(deltax,
+            deltat, diffusivity, temps, start_bc, end_bc, ntimes, obs_steps,
+            obs_nodes, data, error, checkpoint)
+
+        if estimate_initial:
+
+            return misfit, numpy.concatenate([grad_diffusivity, grad_initial])
+
+        return misfit, grad_diffusivity
+
+    params = numpy.array(diffusivity, dtype='f8')
+
+    if estimate_initial:
+
+        params = numpy.concatenate([params, numpy.asarray(initial, 'f8')])
+
+    # Keep the diffusivity positive and the time steps stable
+    spacing = diffusionfd1d._spacings(deltax) if numpy.ndim(deltax) == 0 \
+              else numpy.diff(deltax)
+
+    lower = numpy.zeros_like(params) - numpy.inf
+
+    lower[:nodes] = 10**(-6)*abs(params[:nodes]).max()
+
+    upper = numpy.zeros_like(params) + numpy.inf
+
+    upper[:nodes] = 0.5*numpy.min(spacing)**2/deltat
+
+    blocks = [slice(0, nodes), slice(nodes, len(params))]
+
+    misfit, gradient = evaluate(params)
+
+    goals = [misfit]
+
+    history = []
+
+    for iteration in xrange(max_it):
+
+        # Nowhere to go (e.g., the initial estimate already fits the data)
+        if not gradient.any():
+
+            break
+
+        # Two-loop recursion for the L-BFGS direction
+        direction = -gradient
+
+        alphas = []
+
+        for change, grad_change in reversed(history):
+
+            alpha = numpy.dot(change, direction)/numpy.dot(grad_change, change)
+
+            direction = direction - alpha*grad_change
+
+            alphas.append(alpha)
+
+        if history:
+
+            change, grad_change = history[-1]
+
+            direction *= (numpy.dot(change, grad_change)/
+                          numpy.dot(grad_change, grad_change))
+
+        else:
+
+            # Scale the first step to change the parameters by 10% at most
+            direction *= min(0.1*abs(params[block]).max()/
+                             abs(direction[block]).max()
+                             for block in blocks if abs(direction[block]).any())
+
+        for (change, grad_change), alpha in zip(history, reversed(alphas)):
+
+            beta = numpy.dot(grad_change, direction)/numpy.dot(grad_change,
+                                                               change)
+
+            direction = direction + (alpha - beta)*change
+
+        # Backtracking line search (unstable steps give nan misfits)
+        step = 1.
+
+        for search in xrange(30):
+
+            trial = numpy.clip(params + step*direction, lower, upper)
+
+            trial_misfit, trial_gradient = evaluate(trial)
+
+            if trial_misfit <= misfit + 10**(-4)*numpy.dot(gradient,
+                                                           trial - params):
+
+                break
+
+            step *= 0.5
+
+        else:
+
+            break
+
+        if numpy.dot(trial - params, trial_gradient - gradient) > 0:
+
+            history.append((trial - params, trial_gradient - gradient))
+
+            history = history[-memory:]
+
+        params, misfit, gradient = trial, trial_misfit, trial_gradient
+
+        goals.append(misfit)
+
+        if goals[-2] - goals[-1] <= 10**(-8)*goals[-2]:
+
+            break
+
+    diffusivity, temps = unpack(params)
+
+    return [diffusivity, numpy.copy(temps), goals]
@@ -0,0 +1,394 @@
+# Copyright 2010 Leonardo Uieda
+#
+# This file is part of Geothermics.
+#
+# Fatiando a Terra is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Geothermics is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Geothermics.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Loading of large temperature-depth catalogues.
+
+The text (or CSV) file is parsed in chunks and the result is cached as binary
+files that are memory-mapped on the next load. The rows are grouped by site so
+that each profile is a contiguous slice of the cached arrays.
+"""
+__author__ = 'Leonardo Uieda <leouieda@gmail.com>'
+
+
+import os
+import itertools
+import tempfile
+
+import numpy
+
+
+class Catalogue(object):
+    """
+    Temperature-depth profiles grouped by site.
+
+    Use *load* to create one from a file.
+
+    Attributes:
+
+    * depths, temps
+        1D arrays with all the data, sorted by site
+
+    * offsets
+        Position in *depths* and *temps* where each site starts. The last
+        element is the total number of data.
+
+    * sites
+        Label of each site (in the order they first appear in the file)
+    """
+
+    def __init__(self, depths, temps, offsets, sites):
+
+        self.depths = depths
+        self.temps = temps
+        self.offsets = offsets
+        self.sites = sites
+        self._index = dict((site, i) for i, site in enumerate(sites))
+
+    def __len__(self):
+
+        return len(self.sites)
+
+    def index(self, site):
+        """
+        Return the position of the profile with label *site*.
+        """
+
+        return self._index[str(site)]
+
+    def profile(self, i):
+        """
+        Return the [depths, temps] of the *i*-th profile.
+
+        The arrays are views of the catalogue (read-only if memory-mapped), so
+        copy them before changing in place.
+        """
+
+        start, end = self.offsets[i], self.offsets[i + 1]
+
+        return [self.depths[start:end], self.temps[start:end]]
+
+    def profiles(self):
+        """
+        Iterate over the profiles yielding [site, depths, temps].
+        """
+
+        for i, site in enumerate(self.sites):
+
+            depths, temps = self.profile(i)
+
+            yield [site, depths, temps]
+
+
+def _cache_files(cache):
+    """
+    Name of the files in the cache directory.
+    """
+
+    names = ['depths', 'temps', 'offsets', 'sites', 'source']
+
+    return dict((name, os.path.join(cache, name + '.npy')) for name in names)
+
+
+def _source_stamp(fname, delimiter, comments, skiprows):
+    """
+    Size and modification time of the source file and the options it was
+    parsed with, used to validate the cache.
+    """
+
+    info = os.stat(fname)
+
+    return numpy.array([repr(value) for value in [info.st_size, info.st_mtime,
+                                                  delimiter, comments,
+                                                  skiprows]], dtype='S')
+
+
+def _parse_chunk(lines, first, delimiter, comments, ncols):
+    """
+    Split a chunk of lines into the fields of each row.
+
+    *first* is the line number of the first line of the chunk and *ncols* the
+    number of columns of the file (or None to take it from the first row).
+    Raises ValueError if a row has a different number of columns.
+    """
+
+    rows = []
+
+    for number, line in enumerate(lines, first):
+
+        if not line.strip() or line.startswith(comments):
+
+            continue
+
+        fields = [field.strip() for field in line.split(delimiter)]
+
+        if ncols is None:
+
+            ncols = len(fields)
+
+        if len(fields) != ncols or ncols < 2:
+
+            raise ValueError("Line %d has %d columns instead of %d"
+                             % (number, len(fields), max(ncols, 2)))
+
+        rows.append(fields)
+
+    return rows
+
+
+def _spill(fname, outputs, delimiter, comments, skiprows, chunksize):
+    """
+    Parse the catalogue in chunks writing the depths, temperatures and site
+    codes to the raw binary files in *outputs*.
+
+    Returns [site labels, number of data]
+    """
+
+    codes = {}
+
+    sites = []
+
+    ndata = 0
+
+    ncols = None
+
+    first = skiprows + 1
+
+    source = open(fname, 'r')
+
+    try:
+
+        for line in itertools.islice(source, skiprows):
+
+            pass
+
+        while True:
+
+            lines = list(itertools.islice(source, chunksize))
+
+            if not lines:
+
+                break
+
+            rows = _parse_chunk(lines, first, delimiter, comments, ncols)
+
+            first += len(lines)
+
+            if not rows:
+
+                continue
+
+            ncols = len(rows[0])
+
+            labels = [row[2] if ncols > 2 else '' for row in rows]
+
+            for label in labels:
+
+                if label not in codes:
+
+                    codes[label] = len(sites)
+
+                    sites.append(label)
+
+            numpy.array([row[0] for row in rows],
+                        dtype='f8').tofile(outputs['depths'])
+            numpy.array([row[1] for row in rows],
+                        dtype='f8').tofile(outputs['temps'])
+            numpy.array([codes[label] for label in labels],
+                        dtype='i8').tofile(outputs['codes'])
+
+            ndata += len(rows)
+
+    finally:
+
+        source.close()
+
+    return [sites, ndata]
+
+
+def _parse(fname, cache, delimiter, comments, skiprows, chunksize):
+    """
+    Parse the catalogue in chunks and write the binary cache.
+
+    The data are spilled to raw binary files as they are parsed so that only
+    one chunk of text is kept in memory at a time. The raw files are removed
+    even if the parsing fails.
+    """
+
+    files = _cache_files(cache)
+
+    raw = dict((name, os.path.join(cache, name + '.raw'))
+               for name in ['depths', 'temps', 'codes'])
+
+    outputs = {}
+
+    try:
+
+        for name in raw:
+
+            outputs[name] = open(raw[name], 'wb')
+
+        sites, ndata = _spill(fname, outputs, delimiter, comments, skiprows,
+                              chunksize)
+
+        for output in outputs.itervalues():
+
+            output.close()
+
+        counts = numpy.zeros(len(sites), dtype='i8')
+
+        for name in ['depths', 'temps']:
+
+            if not ndata:
+
+                # Empty files can't be memory-mapped
+                numpy.save(files[name], numpy.empty(0))
+
+                continue
+
+            if name == 'depths':
+
+                site_codes = numpy.fromfile(raw['codes'], dtype='i8')
+
+                # Stable sort keeps the file order of the data inside each
+                # site
+                order = numpy.argsort(site_codes, kind='mergesort')
+
+                counts = numpy.bincount(site_codes, minlength=len(sites))
+
+                del site_codes
+
+            values = numpy.memmap(raw[name], dtype='f8', mode='r',
+                                  shape=(ndata,))
+
+            sorted_values = numpy.lib.format.open_memmap(files[name],
+                                                         mode='w+',
+                                                         dtype='f8',
+                                                         shape=(ndata,))
+
+            sorted_values[:] = values[order]
+
+            sorted_values.flush()
+
+            del values, sorted_values
+
+    finally:
+
+        for name in outputs:
+
+            outputs[name].close()
+
+            os.remove(raw[name])
+
+    offsets = numpy.zeros(len(sites) + 1, dtype='i8')
+
+    offsets[1:] = numpy.cumsum(counts)
+
+    numpy.save(files['offsets'], offsets)
+    numpy.save(files['sites'], numpy.array(sites, dtype='S'))
+
+    # Written last so that an interrupted parse leaves an invalid cache
+    numpy.save(files['source'], _source_stamp(fname, delimiter, comments,
+                                              skiprows))
+
+
+def load(fname, delimiter=None, comments='#', skiprows=0, cache=None,
+         chunksize=100000):
+    """
+    Load a temperature-depth catalogue from a text or CSV file.
+
+    Each row of the file should have depth, temperature and (optionally) a
+    site label. Files without the site column are loaded as a single profile.
+    All rows must have the same number of columns (raises ValueError
+    otherwise). Site labels can contain spaces if a *delimiter* is given.
+
+    The parsed data are cached as memory-mapped binary files so that later
+    loads of the same file don't parse the text again. The cache is refreshed
+    if the file or the *delimiter*, *comments* or *skiprows* change.
+
+    Parameters:
+
+    * fname
+        Name of the catalogue file
+
+    * delimiter
+        Column delimiter (e.g. ``','`` for CSV). If None, any whitespace.
+
+    * comments
+        Lines starting with this are ignored
+
+    * skiprows
+        Number of lines to skip at the beginning of the file (e.g. a header)
+
+    * cache
+        Directory where the binary cache is kept. Defaults to
+        ``fname + '.cache'``. If False, will parse the file and load the cache
+        into memory without keeping it.
+
+    * chunksize
+        Number of lines parsed at a time
+
+    Returns:
+
+    * Catalogue
+        The profiles grouped by site
+    """
+
+    keep = cache is not False
+
+    if cache is None:
+
+        cache = fname + '.cache'
+
+    elif cache is False:
+
+        cache = tempfile.mkdtemp()
+
+    files = _cache_files(cache)
+
+    valid = (keep and os.path.exists(files['source']) and
+             numpy.array_equal(numpy.load(files['source']),
+                               _source_stamp(fname, delimiter, comments,
+                                             skiprows)))
+
+    if not valid:
+
+        if not os.path.isdir(cache):
+
+            os.makedirs(cache)
+
+        if os.path.exists(files['source']):
+
+            os.remove(files['source'])
+
+        _parse(fname, cache, delimiter, comments, skiprows, chunksize)
+
+    mode = 'r' if keep else None
+
+    depths = numpy.load(files['depths'], mmap_mode=mode)
+    temps = numpy.load(files['temps'], mmap_mode=mode)
+    offsets = numpy.load(files['offsets'])
+    sites = [str(site) for site in numpy.load(files['sites'])]
+
+    if not keep:
+
+        for name in files:
+
+            os.remove(files[name])
+
+        os.rmdir(cache)
+
+    return Catalogue(depths, temps, offsets, sites)
@@ -20,10 +20,128 @@ Finite Differences (FD) solvers for the 1D heat diffusion equation
 __author__ = 'Leonardo Uieda <leouieda@gmail.com>'
 
 
-from geothermics._diffusionfd import timestep1d as fortran_timestep
+import sys
+import timeit
+
+import numpy
+
+# Name of the time step kernel, storage type and name of the compiled loop 
+# for each precision mode
+_precisions = {'double':('timestep1d', 'f8', 'run1d'),
+               'single':('timestep1d_sp', 'f4', 'run1d_sp'),
+               'mixed':('timestep1d_mixed', 'f4', 'run1d_mixed')}
+
+
+def _fortran(name):
+    """
+    Get a function from the compiled extension. The extension is only loaded
+    on first use so that importing this module stays cheap.
+    """
+
+    from geothermics import _diffusionfd
+
+    return getattr(_diffusionfd, name)
+
+
+def _kernel(precision, deltax):
+    """
+    Get the time step kernel for a precision mode and grid. Non-uniform grids
+    (*deltax* is an array of node coordinates) are only supported in double 
+    precision.
+    """
+    
+    if numpy.ndim(deltax) == 0:
+        
+        return _fortran(_precisions[precision][0])
+    
+    if precision != 'double':
+        
+        raise ValueError("Non-uniform grids need double precision")
+    
+    return _fortran('timestep1d_nonuniform')
+
+
+def _loop(precision, deltax):
+    """
+    Get the compiled loop of 'run' for a precision mode and grid (see 
+    '_kernel').
+    """
+    
+    if numpy.ndim(deltax) == 0:
+        
+        return _fortran(_precisions[precision][2])
+    
+    if precision != 'double':
+        
+        raise ValueError("Non-uniform grids need double precision")
+    
+    return _fortran('run1d_nonuniform')
    
     
     
+def _spacings(deltax):
+    """
+    Spacing between the first two and the last two nodes.
+    """
+    
+    if numpy.ndim(deltax) == 0:
+        
+        return deltax, deltax
+    
+    return deltax[1] - deltax[0], deltax[-1] - deltax[-2]
+
+
+def _tag(bc, kind, value, knots, side):
+    """
+    Attach the kind of boundary condition, its value if constant in time
+    (None otherwise), its [times, values] knots (interpolated linearly in time
+    and held constant outside) and the side it applies to. These let the
+    direct solvers and the compiled loop in 'run' apply the condition without
+    calling it.
+    """
+    
+    bc.kind, bc.value, bc.knots, bc.side = kind, value, knots, side
+    
+    return bc
+
+
+def _check_sides(start_bc, end_bc):
+    """
+    Check that the built-in boundary conditions are passed as the side they 
+    were made for. Raises ValueError otherwise.
+    """
+    
+    for bc, side in [(start_bc, 'start'), (end_bc, 'end')]:
+        
+        if getattr(bc, 'side', side) != side:
+            
+            raise ValueError("Boundary condition made for the %s " % (bc.side)
+                             + "passed as %s_bc" % (side))
+    
+    
+def _constant(value):
+    """
+    Knots of a boundary value that is constant in time.
+    """
+    
+    return [numpy.zeros(1), numpy.array([value], dtype='f8')]
+    
+    
+def _apply_bc(bc, temps, time, spacing):
+    """
+    Apply a boundary condition. Built-in ones also get the time and the node
+    spacing at the boundary.
+    """
+    
+    if hasattr(bc, 'kind'):
+        
+        bc(temps, time, spacing)
+        
+    else:
+        
+        bc(temps)
+    
+    
 def fixed_bc(start_val, end_val):
     """
     Set fixed boundary conditions.
@@ -39,15 +157,16 @@ def fixed_bc(start_val, end_val):
       [start_bc, end_bc]: callable boundary conditions to pass to 'run' 
     """
     
-    def start_bc(temps):
+    def start_bc(temps, time=0., spacing=1.):
         
         temps[0] = start_val
         
-    def end_bc(temps):
+    def end_bc(temps, time=0., spacing=1.):
         
         temps[-1] = end_val
 
-    return start_bc, end_bc
+    return (_tag(start_bc, 'fixed', start_val, _constant(start_val), 'start'),
+            _tag(end_bc, 'fixed', end_val, _constant(end_val), 'end'))
     
     
 def free_bc():
@@ -59,18 +178,121 @@ def free_bc():
       [start_bc, end_bc]: callable boundary conditions to pass to 'run' 
     """
     
-    def start_bc(temps):
+    def start_bc(temps, time=0., spacing=1.):
         
         temps[0] = temps[1]
         
-    def end_bc(temps):
+    def end_bc(temps, time=0., spacing=1.):
         
         temps[-1] = temps[-2]
         
-    return start_bc, end_bc
+    return (_tag(start_bc, 'free', 0, _constant(0), 'start'), 
+            _tag(end_bc, 'free', 0, _constant(0), 'end'))
+    
+
+def _side_index(side):
+    """
+    Index of the boundary node of *side* ('start' or 'end').
+    """
+    
+    if side not in ['start', 'end']:
+        
+        raise ValueError("side must be 'start' or 'end'")
     
+    return 0 if side == 'start' else -1
+
+
+def temperature_bc(times, temps, side):
+    """
+    Set a fixed temperature boundary condition that varies in time (e.g., a
+    paleoclimate surface temperature history).
+    
+    The temperature is linearly interpolated between the given times and held
+    constant before the first and after the last.
     
-def timestep(temp, deltax, deltat, diffusivity, start_bc, end_bc):
+    Parameters:
+    
+      times: 1D array-like increasing times of the temperature history
+      
+      temps: 1D array-like temperature at each time
+      
+      side: 'start' or 'end'. Must be passed to 'run' as start_bc or end_bc
+            accordingly.
+      
+    Returns:
+    
+      bc: callable boundary condition to pass to 'run' as start_bc or end_bc
+    """
+    
+    index = _side_index(side)
+    
+    times = numpy.array(times, dtype='f8')
+    
+    temps = numpy.array(temps, dtype='f8')
+    
+    def bc(temperature, time=0., spacing=1.):
+        
+        temperature[index] = numpy.interp(time, times, temps)
+    
+    return _tag(bc, 'fixed', temps[0] if len(times) == 1 else None, 
+                [times, temps], side)
+
+
+def flux_bc(times, fluxes, side, conductivity=1.):
+    """
+    Set a prescribed heat flux (Neumann) boundary condition that may vary in 
+    time (e.g., a changing basal heat flux).
+    
+    Positive fluxes flow towards the start (e.g., upwards if the nodes are
+    ordered by depth), so temperatures increase towards the end with gradient
+    flux/conductivity. The flux is linearly interpolated between the given 
+    times and held constant before the first and after the last.
+    
+    Parameters:
+    
+      times: 1D array-like increasing times of the flux history. Use a single
+             time for a constant flux.
+      
+      fluxes: 1D array-like heat flux at each time
+      
+      side: 'start' or 'end'. Must be passed to 'run' as start_bc or end_bc
+            accordingly.
+      
+      conductivity: thermal conductivity at the boundary
+      
+    Returns:
+    
+      bc: callable boundary condition to pass to 'run' as start_bc or end_bc
+    """
+    
+    _side_index(side)
+    
+    times = numpy.array(times, dtype='f8')
+    
+    gradients = numpy.array(fluxes, dtype='f8')/conductivity
+    
+    if side == 'start':
+    
+        def bc(temps, time=0., spacing=1.):
+            
+            gradient = numpy.interp(time, times, gradients)
+            
+            temps[0] = temps[1] - gradient*spacing
+            
+    else:
+    
+        def bc(temps, time=0., spacing=1.):
+            
+            gradient = numpy.interp(time, times, gradients)
+            
+            temps[-1] = temps[-2] + gradient*spacing
+    
+    return _tag(bc, 'flux', gradients[0] if len(times) == 1 else None, 
+                [times, gradients], side)
+    
+    
+def timestep(temp, deltax, deltat, diffusivity, start_bc, end_bc, 
+             precision='double', time=0.):
     """
     Run a single time step of the Finite Differences simulation of the 1D heat 
     diffusion equation
@@ -79,7 +301,8 @@ def timestep(temp, deltax, deltat, diffusivity, start_bc, end_bc):
     
       temp: 1D array-like temperature on each FD node
       
-      deltax: spacing between the nodes
+      deltax: spacing between the nodes or, for non-uniform grids, 1D 
+              array-like with the coordinates of the nodes
       
       deltat: time step
       
@@ -88,28 +311,63 @@ def timestep(temp, deltax, deltat, diffusivity, start_bc, end_bc):
       start_bc: callable boundary condition at the starting point
       
       end_bc: callable boundary condition at the ending point
+      
+      precision: 'double', 'single' (float32 storage and arithmetic) or 
+                 'mixed' (float32 storage and float64 arithmetic)
+                 
+      time: time at the end of the step (used by time-dependent boundary
+            conditions)
             
     Returns:
     
       temp: 1D array-like temperature on each FD node at the next time
     """
     
-    temp_tp1 = fortran_timestep(temp, diffusivity, deltat, deltax)
+    _check_sides(start_bc, end_bc)
+    
+    kernel = _kernel(precision, deltax)
+    
+    temp_tp1 = kernel(temp, diffusivity, deltat, deltax)
+    
+    start_spacing, end_spacing = _spacings(deltax)
         
-    start_bc(temp_tp1)
+    _apply_bc(start_bc, temp_tp1, time, start_spacing)
     
-    end_bc(temp_tp1)
+    _apply_bc(end_bc, temp_tp1, time, end_spacing)
     
     return temp_tp1
 
+
+# Codes of the kinds of boundary conditions in the compiled loop
+_bc_codes = {'fixed':0, 'free':1, 'flux':1}
+
+
+def _compiled(start_bc, end_bc):
+    """
+    Check if the run can be done by the compiled loop (built-in boundary 
+    conditions).
+    """
     
-def run(deltax, deltat, diffusivity, initial, start_bc, end_bc, ntimes):
+    return hasattr(start_bc, 'kind') and hasattr(end_bc, 'kind')
+
+
+def run(deltax, deltat, diffusivity, initial, start_bc, end_bc, ntimes,
+        precision='double', profile=False, compiled=True):
     """
     Run the Finite Differences simulation of the 1D heat diffusion equation
     
+    If the boundary conditions are built-in (made by fixed_bc, free_bc, 
+    temperature_bc or flux_bc), all time steps and the boundary conditions 
+    run in a compiled loop (in any precision) that interpolates their knots 
+    in time, so its memory doesn't grow with ntimes. Otherwise, the boundary 
+    conditions are called after every time step.
+    
     Parameters:
       
-      deltax: spacing between the nodes
+      deltax: spacing between the nodes or, for non-uniform grids, 1D 
+              array-like with the coordinates of the nodes. On non-uniform 
+              grids, deltat must be smaller than the square of the smallest 
+              spacing over twice the diffusivity.
       
       deltat: time step
       
@@ -123,22 +381,680 @@ def run(deltax, deltat, diffusivity, initial, start_bc, end_bc, ntimes):
       
       ntimes: number of time steps to run
       
+      precision: 'double', 'single' (float32 storage and arithmetic) or 
+                 'mixed' (float32 storage and float64 arithmetic). The single
+                 and mixed modes halve the memory and bandwidth of the 
+                 temperatures. See 'precision_report' for their accuracy.
+                 
+      profile: if True, measure the time and allocations spent in each phase
+               of the run and return a RunProfile as well. In the compiled 
+               loop, 'arguments' is the conversion of the initial 
+               temperature and diffusivity and 'kernel' the whole loop 
+               (including the boundary conditions). Use compiled=False to 
+               measure the per step costs.
+               
+      compiled: if False, never use the compiled loop (step in Python and 
+                call the boundary conditions after every step)
+      
     Returns:
     
       temps: 1D array-like temperature on each FD node at the end of the run
+      
+      [temps, profile]: if *profile* is True
+    """
+    
+    _check_sides(start_bc, end_bc)
+    
+    if numpy.ndim(deltax) > 0:
+        
+        deltax = numpy.asarray(deltax, dtype='f8')
+        
+    if profile:
+        
+        clock, stats = timeit.default_timer, RunProfile()
+        
+    else:
+        
+        clock, stats = _no_clock, _no_profile
+        
+    begin = clock()
+    
+    if compiled and _compiled(start_bc, end_bc):
+        
+        temps = _run_compiled(deltax, deltat, diffusivity, initial, start_bc,
+                              end_bc, ntimes, precision, clock, stats)
+        
+    elif profile:
+        
+        temps = _run_steps_profiled(deltax, deltat, diffusivity, initial, 
+                                    start_bc, end_bc, ntimes, precision, stats)
+        
+    else:
+        
+        # Not instrumented so that the per step cost is only the kernel and
+        # the boundary conditions
+        temps = _run_steps(deltax, deltat, diffusivity, initial, start_bc,
+                           end_bc, ntimes, precision)
+        
+    if profile:
+        
+        stats.total = clock() - begin
+        
+        return [temps, stats]
+        
+    return temps
+    
+
+class RunProfile(object):
+    """
+    Wall time and allocations spent in each phase of a 'run'.
+    
+    Phases:
+    
+      'setup': conversion of the initial temperatures and diffusivity
+      
+      'arguments': checking and copying of the arguments into arrays of the 
+                   type the kernel takes
+      
+      'kernel': the compiled time step, including allocation of its output
+                (the whole loop in the compiled path of 'run')
+      
+      'boundaries': the Python boundary condition callables (part of
+                    'kernel' in the compiled path of 'run')
+      
+    Attributes:
+    
+      calls, seconds, allocations, nbytes: dictionaries with the number of 
+          calls, wall time, number of arrays allocated and their size in bytes
+          for each phase
+          
+      total: wall time of the whole run
     """
     
-    next = list(initial)
+    phases = ['setup', 'arguments', 'kernel', 'boundaries']
+    
+    def __init__(self):
+        
+        self.calls = dict.fromkeys(self.phases, 0)
+        self.seconds = dict.fromkeys(self.phases, 0.)
+        self.allocations = dict.fromkeys(self.phases, 0)
+        self.nbytes = dict.fromkeys(self.phases, 0)
+        self.total = 0.
+        
+    def add(self, phase, seconds, allocations=0, nbytes=0):
+        """
+        Record a call to *phase*.
+        """
+        
+        self.calls[phase] += 1
+        self.seconds[phase] += seconds
+        self.allocations[phase] += allocations
+        self.nbytes[phase] += nbytes
         
-    start_bc(next)
+    @property
+    def overhead(self):
+        """
+        Wall time spent outside of the kernel.
+        """
+        
+        return self.total - self.seconds['kernel']
     
-    end_bc(next)
+    @property
+    def bound(self):
+        """
+        'kernel' if most of the time is spent in the kernel, 'overhead' 
+        otherwise.
+        """
+        
+        if self.seconds['kernel'] >= self.overhead:
+            
+            return 'kernel'
+        
+        return 'overhead'
+        
+    def __str__(self):
+        
+        lines = ["%-12s %8s %12s %6s %12s %12s" % ('phase', 'calls', 
+                 'seconds', '%', 'allocations', 'bytes')]
         
+        for phase in self.phases + ['other']:
+            
+            if phase == 'other':
+                
+                seconds = self.total - sum(self.seconds.values())
+                calls = allocations = nbytes = ''
+                
+            else:
+                
+                seconds = self.seconds[phase]
+                calls = self.calls[phase]
+                allocations = self.allocations[phase]
+                nbytes = self.nbytes[phase]
+                
+            lines.append("%-12s %8s %12.6f %6.1f %12s %12s" % (phase, calls, 
+                         seconds, 100.*seconds/max(self.total, 1e-300),
+                         allocations, nbytes))
+            
+        lines.append("total: %g s (%s-bound)" % (self.total, self.bound))
+        
+        return '\n'.join(lines)
+    
+
+def _no_clock():
+    """
+    Timer used when not profiling.
+    """
+    
+    return 0.
+
+
+class _NoProfile(object):
+    """
+    Stands in for a RunProfile when not profiling.
+    """
+    
+    def add(self, phase, seconds, allocations=0, nbytes=0):
+        
+        pass
+    
+    
+_no_profile = _NoProfile()
+
+
+def _as_kernel_arg(value, dtype):
+    """
+    Convert *value* to the array type the kernel takes, like f2py does.
+    Returns [array, copied].
+    """
+    
+    array = numpy.asarray(value, dtype=dtype)
+    
+    return array, array is not value
+        
+        
+def _run_compiled(deltax, deltat, diffusivity, initial, start_bc, end_bc, 
+                  ntimes, precision, clock, stats):
+    """
+    Run all time steps and apply the boundary conditions in the compiled loop.
+    Records the phases in *stats*.
+    """
+    
+    loop, dtype = _loop(precision, deltax), _precisions[precision][1]
+    
+    start = clock()
+    
+    temp, copied_temp = _as_kernel_arg(initial, dtype)
+    
+    diff, copied_diff = _as_kernel_arg(diffusivity, dtype)
+    
+    stats.add('arguments', clock() - start, copied_temp + copied_diff,
+              copied_temp*temp.nbytes + copied_diff*diff.nbytes)
+        
+    start = clock()
+    
+    # The loop interpolates the knots of the boundary conditions in time
+    temps = loop(temp, diff, deltat, deltax, ntimes, _bc_codes[start_bc.kind],
+                 start_bc.knots[0], start_bc.knots[1], _bc_codes[end_bc.kind],
+                 end_bc.knots[0], end_bc.knots[1])
+    
+    # Output plus the work array of the loop
+    stats.add('kernel', clock() - start, 2, 2*temps.nbytes)
+    
+    return temps
+        
+        
+def _bc_caller(bc, spacing):
+    """
+    Make a function that applies a boundary condition given the temperatures
+    and the time. Built-in ones also get the node spacing at the boundary.
+    """
+    
+    if hasattr(bc, 'kind'):
+        
+        def apply(temps, time):
+            
+            bc(temps, time, spacing)
+            
+        return apply
+    
+    def apply(temps, time):
+        
+        bc(temps)
+        
+    return apply
+
+
+def _step_setup(deltax, diffusivity, initial, start_bc, end_bc, precision):
+    """
+    Convert the initial temperature and diffusivity once to the type the 
+    kernel takes (so that it doesn't copy them on every step) and get the 
+    kernel and the functions that apply the boundary conditions.
+    
+    Returns [kernel, temps, diffusivity, apply_start, apply_end]
+    """
+    
+    kernel, dtype = _kernel(precision, deltax), _precisions[precision][1]
+    
+    start_spacing, end_spacing = _spacings(deltax)
+    
+    return [kernel, numpy.array(initial, dtype=dtype), 
+            numpy.asarray(diffusivity, dtype=dtype),
+            _bc_caller(start_bc, start_spacing), 
+            _bc_caller(end_bc, end_spacing)]
+        
+        
+def _run_steps(deltax, deltat, diffusivity, initial, start_bc, end_bc, ntimes,
+               precision):
+    """
+    Run the time steps one kernel call at a time, calling the boundary 
+    conditions after each.
+    """
+    
+    kernel, temps, diffusivity, apply_start, apply_end = _step_setup(deltax, 
+        diffusivity, initial, start_bc, end_bc, precision)
+    
+    apply_start(temps, 0.)
+    
+    apply_end(temps, 0.)
+    
+    for step in xrange(1, ntimes + 1):
+        
+        temps = kernel(temps, diffusivity, deltat, deltax)
+        
+        apply_start(temps, step*deltat)
+        
+        apply_end(temps, step*deltat)
+        
+    return temps
+
+
+def _run_steps_profiled(deltax, deltat, diffusivity, initial, start_bc, 
+                        end_bc, ntimes, precision, stats):
+    """
+    Same as '_run_steps' but recording the time and allocations of each phase
+    in *stats*.
+    """
+    
+    clock = timeit.default_timer
+    
+    start = clock()
+    
+    kernel, temps, diff, apply_start, apply_end = _step_setup(deltax, 
+        diffusivity, initial, start_bc, end_bc, precision)
+    
+    copied_diff = diff is not diffusivity
+    
+    stats.add('setup', clock() - start, 1 + copied_diff, 
+              temps.nbytes + copied_diff*diff.nbytes)
+    
+    start = clock()
+        
+    apply_start(temps, 0.)
+    
+    apply_end(temps, 0.)
+    
+    stats.add('boundaries', clock() - start)
+        
+    dtype = temps.dtype
+        
+    for step in xrange(1, ntimes + 1):
+        
+        start = clock()
+        
+        temp, copied_temp = _as_kernel_arg(temps, dtype)
+        
+        diff, copied_diff = _as_kernel_arg(diff, dtype)
+        
+        stats.add('arguments', clock() - start, copied_temp + copied_diff,
+                  copied_temp*temp.nbytes + copied_diff*diff.nbytes)
+        
+        start = clock()
+        
+        temps = kernel(temp, diff, deltat, deltax)
+        
+        stats.add('kernel', clock() - start, 1, temps.nbytes)
+        
+        start = clock()
+        
+        apply_start(temps, step*deltat)
+        
+        apply_end(temps, step*deltat)
+        
+        stats.add('boundaries', clock() - start)
+        
+    return temps
+    
+    
+# Number of float32 roundings per step of each precision mode, per unit of
+# diffusivity*deltat/deltax**2, that can reach the result of a node (see 
+# precision_report)
+_roundings = {'single':39, 'mixed':4}
+
+
+def precision_report(deltax, deltat, diffusivity, initial, start_bc, end_bc, 
+                     ntimes):
+    """
+    Compare the accuracy of the 'single' and 'mixed' precision modes of 'run'
+    against the double precision result.
+    
+    The 'bound' is a worst case for the rounding errors (to first order in 
+    the float32 unit roundoff u and ignoring double precision roundings). 
+    With M the largest temperature during the run and r the largest 
+    diffusivity*deltat/deltax**2, rounding the result of a step adds at most 
+    u*M. In 'single', r has a relative error of at most 7u (storage of the 
+    diffusivity, deltat and deltax and 4 operations), the second difference 
+    an absolute error of at most 7u*M (2 subtractions of values up to 3M and 
+    4M) and their product another 4u*r*M, for u*M*(1 + 39r) per step. In 
+    'mixed', only the storage of the diffusivity and of the result round, for
+    u*M*(1 + 4r). The scheme is stable for r <= 0.5 and doesn't amplify 
+    errors, so they at most add up over the steps (plus u*M for storing the 
+    initial temperature).
+    
+    Parameters are the same as 'run' (the grid must be uniform).
+    
+    Returns:
+    
+      report: dictionary with an entry for 'single' and 'mixed'. Each is a
+              dictionary with:
+              
+        'max_error': maximum absolute difference to the double precision run
+        
+        'rms_error': root mean square difference
+        
+        'bound': worst case rounding error (see above)
+                 
+        'bytes': memory used by the temperatures on the FD nodes
+    """
+    
+    # Step in double precision to get the largest temperature during the run
+    reference = numpy.array(initial, dtype='f8')
+    
+    _apply_bc(start_bc, reference, 0., deltax)
+    
+    _apply_bc(end_bc, reference, 0., deltax)
+    
+    scale = abs(reference).max()
+    
     for time in xrange(ntimes):
         
-        prev = next
+        reference = timestep(reference, deltax, deltat, diffusivity, start_bc,
+                             end_bc, 'double', (time + 1)*deltat)
+        
+        scale = max(scale, abs(reference).max())
+    
+    ratio = numpy.max(diffusivity)*deltat/deltax**2
+    
+    unit = 0.5*numpy.finfo('f4').eps
+    
+    report = {}
+    
+    for precision in ['single', 'mixed']:
+        
+        result = run(deltax, deltat, diffusivity, initial, start_bc, end_bc,
+                     ntimes, precision)
+        
+        error = numpy.asarray(result, dtype='f8') - reference
+        
+        report[precision] = {
+            'max_error':abs(error).max(),
+            'rms_error':numpy.sqrt((error**2).mean()),
+            'bound':unit*scale*(1 + ntimes*(1 + _roundings[precision]*ratio)),
+            'bytes':result.nbytes}
+        
+    return report
+
+
+def _bc_kind(bc):
+    """
+    Get the kind and value of a built-in boundary condition that is constant 
+    in time. Raises ValueError for others.
+    """
+    
+    if not hasattr(bc, 'kind'):
+        
+        raise ValueError("Boundary conditions must be made by fixed_bc, " +
+                         "free_bc, temperature_bc or flux_bc")
+        
+    if bc.value is None:
+        
+        raise ValueError("Boundary conditions must be constant in time")
+        
+    return bc.kind, bc.value
+    
+    
+def steady_state(deltax, diffusivity, start_bc, end_bc, source=None):
+    """
+    Solve directly for the equilibrium (steady-state) temperature of the Finite
+    Differences simulation of the 1D heat diffusion equation.
+    
+    This is the profile that 'run' converges to after many time steps but 
+    costs a single O(n) tridiagonal solve.
+    
+    Parameters:
+      
+      deltax: spacing between the nodes or, for non-uniform grids, 1D 
+              array-like with the coordinates of the nodes
+      
+      diffusivity: 1D array-like thermal diffusivity on each FD node
+      
+      start_bc: boundary condition at the starting point (from 'fixed_bc', 
+                'free_bc' or constant 'temperature_bc' or 'flux_bc')
+      
+      end_bc: boundary condition at the ending point (same as start_bc)
+              
+      source: 1D array-like heat source on each FD node (in temperature per
+              time, i.e. already divided by density and heat capacity). If 
+              None, no sources.
+      
+    Returns:
+    
+      temps: 1D array-like temperature on each FD node at equilibrium
+    """
+    
+    diffusivity = numpy.asarray(diffusivity, dtype='f8')
+    
+    nodes = len(diffusivity)
+    
+    start_kind, start_val = _bc_kind(start_bc)
+    
+    end_kind, end_val = _bc_kind(end_bc)
+    
+    _check_sides(start_bc, end_bc)
+    
+    if start_kind != 'fixed' and end_kind != 'fixed':
+        
+        raise ValueError("Steady-state is not unique without a fixed " +
+                         "temperature on one of the ends")
+    
+    if numpy.ndim(deltax) == 0:
+        
+        spacing = deltax*numpy.ones(nodes - 1)
+        
+    else:
+        
+        spacing = numpy.diff(numpy.asarray(deltax, dtype='f8'))
+    
+    # Non-uniform stencil multiplied by the mean spacing around each node
+    lower = numpy.ones(nodes)
+    upper = numpy.ones(nodes)
+    lower[1:-1] = 1./spacing[:-1]
+    upper[1:-1] = 1./spacing[1:]
+    diag = -(lower + upper)
+    rhs = numpy.zeros(nodes)
+    
+    if source is not None:
+        
+        rhs[1:-1] = -0.5*(spacing[:-1] + spacing[1:])*(
+            numpy.asarray(source)[1:-1]/diffusivity[1:-1])
+        
+    # Fixed: temps[0] = value. Free or flux: temps[0] - temps[1] = -gradient*h
+    diag[0] = 1
+    upper[0] = 0 if start_kind == 'fixed' else -1
+    rhs[0] = start_val if start_kind == 'fixed' else -start_val*spacing[0]
+    
+    diag[-1] = 1
+    lower[-1] = 0 if end_kind == 'fixed' else -1
+    rhs[-1] = end_val if end_kind == 'fixed' else end_val*spacing[-1]
+    
+    return _fortran('solvetridiag')(lower, diag, upper, rhs)
+
+
+def _dst1(values):
+    """
+    Type I Discrete Sine Transform (unnormalized) along the last axis using 
+    the FFT of the odd extension of the values.
+    """
+    
+    size = values.shape[-1]
+    
+    extended = numpy.zeros(values.shape[:-1] + (2*(size + 1),))
+    
+    extended[..., 1:size + 1] = values
+    
+    extended[..., size + 2:] = -values[..., ::-1]
+    
+    return -0.5*numpy.fft.rfft(extended).imag[..., 1:size + 1]
+    
+
+def _idst1(coefs):
+    """
+    Inverse of '_dst1'.
+    """
+    
+    return _dst1(coefs)*2./(coefs.shape[-1] + 1)
+    
+    
+def _dct2(values):
+    """
+    Type II Discrete Cosine Transform (unnormalized) along the last axis using
+    the FFT of the even extension of the values.
+    """
+    
+    size = values.shape[-1]
+    
+    extended = numpy.concatenate([values, values[..., ::-1]], axis=-1)
+    
+    shift = numpy.exp(-0.5j*numpy.pi*numpy.arange(size)/size)
+    
+    return 0.5*(shift*numpy.fft.rfft(extended)[..., :size]).real
+
+
+def _idct2(coefs):
+    """
+    Inverse of '_dct2'.
+    """
+    
+    size = coefs.shape[-1]
+    
+    spectrum = numpy.zeros(coefs.shape[:-1] + (size + 1,), dtype='c16')
+    
+    spectrum[..., :size] = 2*coefs*numpy.exp(0.5j*numpy.pi*
+                                             numpy.arange(size)/size)
+    
+    return numpy.fft.irfft(spectrum, 2*size)[..., :size]
+    
+    
+def spectral(deltax, diffusivity, initial, start_bc, end_bc, times):
+    """
+    Calculate the temperature at arbitrary times without time stepping when 
+    the thermal diffusivity is homogeneous.
+    
+    The FD equations (continuous in time) are diagonalized by a sine transform
+    for fixed boundaries and a cosine transform for free boundaries. Each 
+    output time costs one O(n log n) transform. The result is what 'run' 
+    converges to as deltat goes to zero.
+    
+    Parameters:
+      
+      deltax: spacing between the nodes
+      
+      diffusivity: thermal diffusivity. Either a scalar or a 1D array-like 
+                   with the same value on all FD nodes
+    
+      initial: 1D array-like temperature on each FD node
+      
+      start_bc: boundary condition at the starting point (from 'fixed_bc' or
+                'free_bc')
+      
+      end_bc: boundary condition at the ending point (same kind as start_bc)
+      
+      times: list of times at which to calculate the temperature
+      
+    Returns:
+    
+      temps: list with the temperature on each FD node at each of *times*
+    """
+    
+    if numpy.ndim(deltax) > 0:
+        
+        raise ValueError("The spectral solver needs uniformly spaced nodes")
+    
+    diffusivity = numpy.unique(numpy.asarray(diffusivity, dtype='f8'))
+    
+    if len(diffusivity) != 1:
+        
+        raise ValueError("Diffusivity must be homogeneous")
+    
+    diffusivity = diffusivity[0]
+    
+    start_kind, start_val = _bc_kind(start_bc)
+    
+    end_kind, end_val = _bc_kind(end_bc)
+    
+    _check_sides(start_bc, end_bc)
+    
+    if start_kind != end_kind or start_kind not in ['fixed', 'free']:
+        
+        raise ValueError("Boundary conditions must be both fixed_bc or " +
+                         "both free_bc")
+    
+    temps = numpy.array(initial, dtype='f8')
+    
+    start_bc(temps)
+    
+    end_bc(temps)
+    
+    # Only the interior nodes evolve, the boundaries follow the conditions
+    nodes = len(temps)
+    
+    size = nodes - 2
+    
+    if start_kind == 'fixed':
+        
+        # Decay the deviation from the linear profile between the boundaries
+        linear = start_val + (end_val - start_val)*numpy.arange(nodes)/(
+            nodes - 1.)
+        
+        coefs = _dst1(temps[1:-1] - linear[1:-1])
+        
+        wavenumbers = numpy.arange(1, size + 1)*numpy.pi/(2.*(size + 1))
+        
+        inverse = _idst1
+        
+    else:
+        
+        linear = numpy.zeros(nodes)
+        
+        coefs = _dct2(temps[1:-1])
+        
+        wavenumbers = numpy.arange(size)*numpy.pi/(2.*size)
+        
+        inverse = _idct2
+        
+    rates = -4.*diffusivity*numpy.sin(wavenumbers)**2/(deltax**2)
+    
+    results = []
+    
+    for time in times:
+        
+        temps = numpy.copy(linear)
+        
+        temps[1:-1] += inverse(coefs*numpy.exp(rates*time))
+        
+        start_bc(temps)
+        
+        end_bc(temps)
         
-        next = timestep(prev, deltax, deltat, diffusivity, start_bc, end_bc)
+        results.append(temps)
         
-    return next
-    
\ No newline at end of file
+    return results
@@ -0,0 +1,616 @@
+# Copyright 2010 Leonardo Uieda
+#
+# This file is part of Geothermics.
+#
+# Fatiando a Terra is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Geothermics is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Geothermics.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Persistent local job server for simulations and inversions.
+
+The server listens on a Unix socket and keeps a pool of worker processes that
+have the compiled kernels loaded. Clients submit jobs (in batches) and wait
+for the results, so small jobs don't pay for interpreter startup and imports.
+
+Start a server from the command line::
+
+    python -m geothermics.jobserver /tmp/geothermics.sock 4
+
+and use it from any script::
+
+    client = Client('/tmp/geothermics.sock')
+    temps = client.map('diffusionfd1d.run',
+                       [(1, 0.4, diffusivity, initial, ('free',), 80)
+                        for initial in initials])
+
+Jobs are given by name (see *jobs*). Boundary conditions of
+'diffusionfd1d.run' and 'diffusionfd1d.steady_state' are given as
+('fixed', start_val, end_val), ('free',) or a pair with one of
+('temperature', times, temps) or ('flux', times, fluxes[, conductivity]) for
+each side, because the callables can't be sent to another process.
+"""
+__author__ = 'Leonardo Uieda <leouieda@gmail.com>'
+
+
+import os
+import sys
+import Queue
+import itertools
+import threading
+import traceback
+import multiprocessing
+import multiprocessing.connection
+
+
+class JobError(Exception):
+    """
+    A job failed in the server. The message has the remote traceback.
+    """
+    pass
+
+
+def _make_bcs(spec):
+    """
+    Make the boundary condition callables from their description. Raises
+    ValueError if it isn't one of the forms in the module docstring.
+    """
+
+    from geothermics import diffusionfd1d
+
+    if spec[0] == 'fixed' and len(spec) == 3:
+
+        return diffusionfd1d.fixed_bc(spec[1], spec[2])
+
+    if spec[0] == 'free' and len(spec) == 1:
+
+        return diffusionfd1d.free_bc()
+
+    factories = {'temperature':diffusionfd1d.temperature_bc,
+                 'flux':diffusionfd1d.flux_bc}
+
+    valid = len(spec) == 2 and all(isinstance(side, (tuple, list)) and
+                                   side and side[0] in factories and
+                                   3 <= len(side) <= 3 + (side[0] == 'flux')
+                                   for side in spec)
+
+    if not valid:
+
+        raise ValueError("Invalid boundary conditions %r. Use ('fixed', "
+                         % (spec,) + "start_val, end_val), ('free',) or a "
+                         "pair with ('temperature', times, temps) or ('flux',"
+                         " times, fluxes[, conductivity]) for each side")
+
+    return [factories[side[0]](side[1], side[2], name, *side[3:])
+            for side, name in zip(spec, ['start', 'end'])]
+
+
+def _run(deltax, deltat, diffusivity, initial, bcs, ntimes, **kwargs):
+
+    from geothermics import diffusionfd1d
+
+    start_bc, end_bc = _make_bcs(bcs)
+
+    return diffusionfd1d.run(deltax, deltat, diffusivity, initial, start_bc,
+                             end_bc, ntimes, **kwargs)
+
+
+def _steady_state(deltax, diffusivity, bcs, source=None):
+
+    from geothermics import diffusionfd1d
+
+    start_bc, end_bc = _make_bcs(bcs)
+
+    return diffusionfd1d.steady_state(deltax, diffusivity, start_bc, end_bc,
+                                      source)
+
+
+def _invert_temp_profile(*args, **kwargs):
+
+    from geothermics import subcrust
+
+    return subcrust.invert_temp_profile(*args, **kwargs)
+
+
+def _synthetic_temp_profile(*args, **kwargs):
+
+    from geothermics import subcrust
+
+    return subcrust.synthetic_temp_profile(*args, **kwargs)
+
+
+# Jobs that can be submitted to the server
+jobs = {'diffusionfd1d.run':_run,
+        'diffusionfd1d.steady_state':_steady_state,
+        'subcrust.invert_temp_profile':_invert_temp_profile,
+        'subcrust.synthetic_temp_profile':_synthetic_temp_profile}
+
+
+def _worker(conn):
+    """
+    Run the batches of jobs received on *conn* until getting None.
+    """
+
+    # Load the solvers and the compiled extension before the first job
+    for module in ['diffusionfd1d', 'subcrust', '_diffusionfd']:
+
+        __import__('geothermics.' + module)
+
+    # The inversions print their progress
+    sys.stdout = open(os.devnull, 'w')
+
+    while True:
+
+        batch = conn.recv()
+
+        if batch is None:
+
+            break
+
+        done = []
+
+        for jobid, name, args, kwargs in batch:
+
+            try:
+
+                done.append((jobid, True, jobs[name](*args, **kwargs)))
+
+            except Exception:
+
+                done.append((jobid, False, traceback.format_exc()))
+
+        conn.send(done)
+
+
+def _spawn():
+    """
+    Start a worker process. Returns [process, connection to it].
+    """
+
+    conn, child = multiprocessing.Pipe()
+
+    process = multiprocessing.Process(target=_worker, args=(child,))
+
+    process.daemon = True
+
+    process.start()
+
+    # So that the connection gets EOF if the worker dies
+    child.close()
+
+    return [process, conn]
+
+
+class JobServer(object):
+    """
+    Job server with a pool of warm worker processes.
+
+    Anyone who can connect to the socket can make the server unpickle what
+    they send, so the socket is only accessible by its owner. Give an
+    *authkey* as well if the directory of the socket isn't private.
+
+    Each batch a client submits is split in up to *nworkers* parts so that
+    idle workers share it. A worker that dies (e.g., a crash in the compiled
+    code) is replaced and the jobs of the part it was running fail with a
+    JobError.
+
+    Parameters:
+
+    * address
+        Path of the Unix socket to listen on
+
+    * nworkers
+        Number of worker processes. Defaults to the number of CPUs.
+
+    * maxpending
+        Maximum number of batches (parts) waiting for a worker. Clients that
+        submit more are blocked until the workers catch up.
+
+    * authkey
+        Key that clients must present to connect (optional)
+    """
+
+    def __init__(self, address, nworkers=None, maxpending=100, authkey=None):
+
+        self.address = address
+        self.nworkers = nworkers or multiprocessing.cpu_count()
+        self.authkey = authkey
+        self._tasks = Queue.Queue(maxpending)
+        self._outboxes = {}
+        self._lock = threading.Lock()
+        self._stop = False
+
+    def _handle(self, conn, client):
+        """
+        Receive messages from a client until it disconnects.
+        """
+
+        try:
+
+            while True:
+
+                message = conn.recv()
+
+                if message[0] == 'submit':
+
+                    batch = message[1]
+
+                    # Split the batch so that all workers share it
+                    size = max(1, -(-len(batch)//self.nworkers))
+
+                    for start in xrange(0, len(batch), size):
+
+                        # Blocks if too many batches are pending
+                        # (backpressure)
+                        self._tasks.put((client, batch[start:start + size]))
+
+                elif message[0] == 'shutdown':
+
+                    self._stop = True
+
+                    # Wake up the accept in serve_forever
+                    multiprocessing.connection.Client(self.address,
+                        'AF_UNIX', authkey=self.authkey).close()
+
+                    break
+
+        except (EOFError, IOError):
+
+            pass
+
+        with self._lock:
+
+            outbox = self._outboxes.pop(client)
+
+        outbox.put(None)
+
+    def _send(self, conn, outbox):
+        """
+        Send the results in *outbox* to a client until getting None. Each
+        client has its own so that a slow one doesn't hold up the others.
+        """
+
+        while True:
+
+            done = outbox.get()
+
+            if done is None:
+
+                break
+
+            try:
+
+                conn.send(('results', done))
+
+            except IOError:
+
+                pass
+
+        conn.close()
+
+    def _deliver(self, client, done):
+        """
+        Queue the results of a batch to be sent to its client (dropped if the
+        client is gone).
+        """
+
+        with self._lock:
+
+            outbox = self._outboxes.get(client)
+
+        if outbox is not None:
+
+            outbox.put(done)
+
+    def _manage(self):
+        """
+        Feed batches to a worker process and deliver the results, replacing
+        the worker if it dies.
+        """
+
+        process, conn = _spawn()
+
+        while True:
+
+            task = self._tasks.get()
+
+            if task is None:
+
+                break
+
+            client, batch = task
+
+            try:
+
+                conn.send(batch)
+
+                done = conn.recv()
+
+            except (EOFError, IOError):
+
+                process.join()
+
+                message = "Worker died (exit code %s) while running the job" \
+                          % (process.exitcode)
+
+                done = [(job[0], False, message) for job in batch]
+
+                conn.close()
+
+                process, conn = _spawn()
+
+            self._deliver(client, done)
+
+        conn.send(None)
+
+        process.join()
+
+    def serve_forever(self):
+        """
+        Start the workers and serve clients until one sends 'shutdown'.
+        """
+
+        managers = [threading.Thread(target=self._manage)
+                    for i in xrange(self.nworkers)]
+
+        for manager in managers:
+
+            manager.daemon = True
+
+            manager.start()
+
+        # Create the socket accessible only by its owner
+        umask = os.umask(0177)
+
+        try:
+
+            listener = multiprocessing.connection.Listener(self.address,
+                'AF_UNIX', authkey=self.authkey)
+
+        finally:
+
+            os.umask(umask)
+
+        try:
+
+            for client in itertools.count():
+
+                conn = listener.accept()
+
+                if self._stop:
+
+                    conn.close()
+
+                    break
+
+                outbox = Queue.Queue()
+
+                with self._lock:
+
+                    self._outboxes[client] = outbox
+
+                for target, args in [(self._handle, (conn, client)),
+                                     (self._send, (conn, outbox))]:
+
+                    thread = threading.Thread(target=target, args=args)
+
+                    thread.daemon = True
+
+                    thread.start()
+
+        finally:
+
+            listener.close()
+
+            for manager in managers:
+
+                self._tasks.put(None)
+
+            for manager in managers:
+
+                manager.join()
+
+
+def start(address, nworkers=None, maxpending=100, authkey=None):
+    """
+    Start a job server in a background process.
+
+    The server keeps running until a client calls *Client.shutdown*.
+
+    Parameters are the same as *JobServer*.
+
+    Returns:
+
+    * process
+        The *multiprocessing.Process* running the server
+    """
+
+    server = JobServer(address, nworkers, maxpending, authkey)
+
+    process = multiprocessing.Process(target=server.serve_forever)
+
+    process.start()
+
+    return process
+
+
+class Client(object):
+    """
+    Connection to a job server.
+
+    Parameters:
+
+    * address
+        Path of the Unix socket of the server
+
+    * authkey
+        Key of the server (if it has one)
+
+    * window
+        Maximum number of jobs waiting for results. Submitting more blocks
+        until results arrive.
+
+    * batchsize
+        Number of jobs sent together by *submit_batch* and *map*
+    """
+
+    def __init__(self, address, authkey=None, window=10000, batchsize=64):
+
+        self.window = window
+        self.batchsize = batchsize
+        self._conn = multiprocessing.connection.Client(address, 'AF_UNIX',
+                                                       authkey=authkey)
+        self._ids = itertools.count()
+        self._pending = set()
+        self._done = {}
+
+    def _receive(self):
+        """
+        Wait for a batch of results from the server.
+        """
+
+        message = self._conn.recv()
+
+        for jobid, ok, value in message[1]:
+
+            self._pending.discard(jobid)
+
+            self._done[jobid] = (ok, value)
+
+    def _send(self, batch):
+
+        # Backpressure: don't let the outstanding jobs grow without bound
+        while len(self._pending) + len(batch) > self.window and self._pending:
+
+            self._receive()
+
+        self._pending.update(job[0] for job in batch)
+
+        self._conn.send(('submit', batch))
+
+    def submit(self, name, *args, **kwargs):
+        """
+        Submit a job.
+
+        Parameters:
+
+        * name
+            Name of the job (one of *jobs*)
+
+        * args, kwargs
+            Arguments of the job
+
+        Returns:
+
+        * jobid
+            Use to get the result with *result*
+        """
+
+        jobid = self._ids.next()
+
+        self._send([(jobid, name, args, kwargs)])
+
+        return jobid
+
+    def submit_batch(self, name, arglist):
+        """
+        Submit many jobs of the same kind.
+
+        Parameters:
+
+        * name
+            Name of the jobs (one of *jobs*)
+
+        * arglist
+            List with the arguments of each job, either a tuple of positional
+            arguments or a [args, kwargs] pair given as a list
+
+        Returns:
+
+        * jobids
+            List with the id of each job
+        """
+
+        batch = []
+
+        jobids = []
+
+        for args in arglist:
+
+            kwargs = {}
+
+            if isinstance(args, list):
+
+                args, kwargs = args
+
+            jobid = self._ids.next()
+
+            jobids.append(jobid)
+
+            batch.append((jobid, name, tuple(args), kwargs))
+
+            if len(batch) == self.batchsize:
+
+                self._send(batch)
+
+                batch = []
+
+        if batch:
+
+            self._send(batch)
+
+        return jobids
+
+    def result(self, jobid):
+        """
+        Wait for the result of a job. Raises *JobError* if it failed.
+        """
+
+        while jobid not in self._done:
+
+            self._receive()
+
+        ok, value = self._done.pop(jobid)
+
+        if not ok:
+
+            raise JobError(value)
+
+        return value
+
+    def map(self, name, arglist):
+        """
+        Run many jobs of the same kind and return their results in order.
+
+        See *submit_batch* for the parameters.
+        """
+
+        return [self.result(jobid)
+                for jobid in self.submit_batch(name, arglist)]
+
+    def shutdown(self):
+        """
+        Stop the server (after the jobs already submitted are done).
+        """
+
+        self._conn.send(('shutdown',))
+
+        self.close()
+
+    def close(self):
+
+        self._conn.close()
+
+
+if __name__ == '__main__':
+
+    JobServer(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else None
+             ).serve_forever()
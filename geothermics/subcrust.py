@@ -20,45 +20,12 @@ Subcrustal Lithosphere geothermal modeling and inversion.
 __author__ = 'Leonardo Uieda <leouieda@gmail.com>'
 
 
+import os
 import time
 
 import numpy
 
 
-def _param_jacobian(estimate, data, depths, ref_temp, ref_cond, ref_depth):
-    """
-    Calculate the Jacobian matrix of the mathematical model with respect to the
-    parameters.
-    """
-
-    qc_deriv = -(depths - ref_depth)/ref_cond
-    
-    A_deriv = ((depths - ref_depth)**2)/(2*ref_cond)
-    
-    B_deriv = 0.5*(data - ref_temp)**2 
-
-    jacobian = numpy.array([A_deriv, B_deriv, qc_deriv]).T
-    
-    return jacobian
-
-
-def _data_jacobian(estimate, data, ref_temp):
-    """
-    Calculate the Jacobian matrix of the mathematical model with respect to the
-    data.
-    """
-
-    B = estimate[1]
-    
-    jacobian = numpy.zeros((len(data), len(data)))
-    
-    for i in xrange(len(data)):
-        
-        jacobian[i][i] = 1 + B*(data[i] - ref_temp)
-
-    return jacobian
-
-
 def _model(estimate, data, depths, ref_temp, ref_cond, ref_depth):
     """
     Calculate the mathematical model for a given estimate and data.
@@ -76,6 +43,312 @@ def _model(estimate, data, depths, ref_temp, ref_cond, ref_depth):
     return f
 
 
+class SubcrustProblem(object):
+    """
+    Forward model, Jacobians and inversion for a fixed set of depths and
+    reference surface.
+
+    Everything that depends only on the depths and reference values is
+    calculated once and the arrays used in the iterations are allocated once.
+    Reuse the same object for repeated inversions and synthetic profiles on
+    the same depths.
+
+    The arrays returned by *forward*, *jacobian* and *data_jacobian* are
+    workspace buffers that are overwritten by the next call. Copy them if you
+    need to keep them.
+
+    Parameters:
+
+    * depths
+        List of depths of the data
+
+    * ref_temp, ref_cond, ref_depth
+        Temperature, conductivity and depth of the reference surface
+    """
+
+    def __init__(self, depths, ref_temp, ref_cond, ref_depth):
+
+        self.depths = numpy.array(depths, dtype='f8')
+        self.ref_temp = ref_temp
+        self.ref_cond = ref_cond
+        self.ref_depth = ref_depth
+        ndata = len(self.depths)
+        # Derivatives with respect to A and qc only depend on depth
+        self._jacobian = numpy.empty((ndata, 3))
+        self._jacobian[:,0] = ((self.depths - ref_depth)**2)/(2*ref_cond)
+        self._jacobian[:,2] = -(self.depths - ref_depth)/ref_cond
+        self._radheat_term = numpy.copy(self._jacobian[:,0])
+        self._flux_term = numpy.copy(self._jacobian[:,2])
+        # Workspace for the iterations
+        self._weighted = numpy.empty((ndata, 3))
+        self._diffs = numpy.empty(ndata)
+        self._f0 = numpy.empty(ndata)
+        self._data_jac = numpy.empty(ndata)
+        self._misfit = numpy.empty(ndata)
+        self._residuals = numpy.empty(ndata)
+        self._adjusted = numpy.empty(ndata)
+
+    def forward(self, estimate, data):
+        """
+        Calculate the mathematical model (same as *_model*) for a given
+        estimate and data. Ideally should be zero.
+        """
+
+        radheat, condvar, flux = estimate
+
+        diffs = numpy.subtract(data, self.ref_temp, self._diffs)
+
+        f0 = numpy.multiply(diffs, diffs, self._f0)
+
+        f0 *= 0.5*condvar
+
+        f0 += diffs
+
+        scratch = numpy.multiply(self._flux_term, flux, self._misfit)
+
+        f0 += scratch
+
+        numpy.multiply(self._radheat_term, radheat, scratch)
+
+        f0 += scratch
+
+        return f0
+
+    def jacobian(self, data):
+        """
+        Calculate the Jacobian matrix of the mathematical model with respect to
+        the parameters [radheat, condvar, flux].
+        """
+
+        diffs = numpy.subtract(data, self.ref_temp, self._diffs)
+
+        column = self._jacobian[:,1]
+
+        numpy.multiply(diffs, diffs, column)
+
+        column *= 0.5
+
+        return self._jacobian
+
+    def data_jacobian(self, estimate, data):
+        """
+        Calculate the diagonal of the Jacobian matrix of the mathematical model
+        with respect to the data (the off-diagonal elements are zero).
+        """
+
+        diffs = numpy.subtract(data, self.ref_temp, self._diffs)
+
+        data_jac = numpy.multiply(diffs, estimate[1], self._data_jac)
+
+        data_jac += 1
+
+        return data_jac
+
+    def invert(self, temps, error, initial_radheat, initial_condvar,
+               initial_flux, max_it=50, verbose=False):
+        """
+        Invert a temperature profile measured at the depths of this problem.
+
+        See *invert_temp_profile* for the parameters and return values. If
+        *verbose*, prints the goal function at each iteration.
+        """
+
+        goals = []
+
+        parameters = numpy.array([initial_radheat, initial_condvar,
+                                  initial_flux], dtype='f8')
+
+        temps = numpy.asarray(temps, dtype='f8')
+
+        adjusted_data = self._adjusted
+
+        adjusted_data[:] = temps
+
+        weighted = self._weighted
+
+        misfit = self._misfit
+
+        residuals = self._residuals
+
+        # Need this to calculate the initial residuals. The data Jacobian is
+        # diagonal so the Lagrange multipliers are an element-wise division.
+        f0 = self.forward(parameters, adjusted_data)
+
+        data_jac = self.data_jacobian(parameters, adjusted_data)
+
+        numpy.divide(f0, data_jac, residuals)
+
+        # Since there is no regularization, the goal function is just the rms
+        goals.append(numpy.dot(residuals, residuals))
+
+        # So that I can warn the user if exited because of max_it and not
+        # because of convergence
+        max_it_exit = True
+
+        for iteration in xrange(max_it):
+
+            start = time.time()
+
+            param_jac = self.jacobian(adjusted_data)
+
+            data_jac = self.data_jacobian(parameters, adjusted_data)
+
+            f0 = self.forward(parameters, adjusted_data)
+
+            # Measure the residuals from the observed data, not from the
+            # adjusted data of the previous iteration (forward is done with
+            # the misfit buffer)
+            numpy.subtract(temps, adjusted_data, misfit)
+
+            misfit *= data_jac
+
+            f0 += misfit
+
+            # Weight the Jacobian by the inverse of data_jac*data_jac.T
+            numpy.multiply(data_jac, data_jac, residuals)
+
+            numpy.divide(param_jac, residuals[:,numpy.newaxis], weighted)
+
+            # Solve for the correction, lagrange multiplier and residuals
+            normal_eq_sys = numpy.dot(weighted.T, param_jac)
+
+            correction = -1*numpy.linalg.solve(normal_eq_sys,
+                                               numpy.dot(weighted.T, f0))
+
+            numpy.dot(param_jac, correction, misfit)
+
+            misfit += f0
+
+            numpy.divide(misfit, data_jac, residuals)
+
+            residuals *= -1
+
+            # Update the adjusted data and parameters
+            residuals += temps
+
+            residuals -= adjusted_data
+
+            change = max(residuals.max(), -residuals.min())
+
+            adjusted_data += residuals
+
+            parameters += correction
+
+            residuals = numpy.subtract(adjusted_data, temps, residuals)
+
+            rms = numpy.dot(residuals, residuals)
+
+            goals.append(rms)
+
+            end = time.time()
+
+            if verbose:
+
+                print "  it %d: RMS=%g (%g s)" % (iteration + 1, rms,
+                                                  end - start)
+
+            if change <= 10**(-2):
+
+                max_it_exit = False
+
+                break
+
+        if max_it_exit and verbose:
+
+            print "WARNING! Exited due to reaching maximum number of " + \
+                  "iterations."
+
+        cov = numpy.linalg.inv(normal_eq_sys)*error**2
+
+        results = [parameters[0], parameters[1], parameters[2], cov,
+                   numpy.copy(adjusted_data), goals]
+
+        return results
+
+    def synthetic(self, radheat, condvar, ref_flux):
+        """
+        Generate a synthetic temperature profile at the depths of this problem.
+
+        See *synthetic_temp_profile* for the parameters and return values.
+        """
+
+        estimate = [radheat, condvar, ref_flux]
+
+        temps = self.ref_temp*numpy.ones_like(self.depths)
+
+        correction = self._residuals
+
+        # Use Newton's method to find the root of the model equation
+        for i in xrange(500):
+
+            f0 = self.forward(estimate, temps)
+
+            data_jac = self.data_jacobian(estimate, temps)
+
+            numpy.divide(f0, data_jac, correction)
+
+            temps -= correction
+
+            if abs(correction.max()) <= 0.1 and abs(correction.min()) <= 0.1:
+
+                break
+
+        return temps
+
+    def synthetic_many(self, estimates, tol=10**(-6), max_it=100):
+        """
+        Generate synthetic temperature profiles for many estimates at once.
+
+        Runs Newton's method on *_model* for all estimates together. Estimates
+        for which the model has no root (or Newton's method doesn't converge)
+        get NaN temperatures.
+
+        Parameters:
+
+        * estimates
+            2D array with one [radheat, condvar, flux] per row
+
+        * tol
+            Stop when the largest temperature correction is below this
+
+        * max_it
+            Maximum iterations of Newton's method
+
+        Returns:
+
+        * temps
+            2D array with the temperatures of each estimate (rows) at the
+            depths of this problem (columns)
+        """
+
+        estimates = numpy.asarray(estimates, dtype='f8')
+
+        # Parameters as columns so that they broadcast over the depths
+        params = estimates.T[:,:,numpy.newaxis]
+
+        temps = self.ref_temp*numpy.ones((len(estimates), len(self.depths)))
+
+        for i in xrange(max_it):
+
+            f0 = _model(params, temps, self.depths, self.ref_temp,
+                        self.ref_cond, self.ref_depth)
+
+            correction = f0/(1 + params[1]*(temps - self.ref_temp))
+
+            temps -= correction
+
+            # Comparisons with NaN are False so diverged estimates don't count
+            if not (abs(correction) > tol).any():
+
+                break
+
+        diverged = ~(abs(correction) <= tol).all(axis=1)
+
+        temps[diverged] = numpy.nan
+
+        return temps
+
+
 def invert_temp_profile(depths, temps, error, initial_radheat, initial_condvar,
                         initial_flux, ref_temp, ref_cond, ref_depth, max_it=50):
     """
@@ -131,96 +404,197 @@ def invert_temp_profile(depths, temps, error, initial_radheat, initial_condvar,
     print "  max iterations=%d" % (max_it)
     print "  data error=%g" % (error)
 
-    goals = []
+    problem = SubcrustProblem(depths, ref_temp, ref_cond, ref_depth)
 
-    parameters = [initial_radheat, initial_condvar, initial_flux]
-    
-    cov = numpy.zeros((3,3))
-    
-    adjusted_data = numpy.copy(temps)
+    return problem.invert(temps, error, initial_radheat, initial_condvar,
+                          initial_flux, max_it, verbose=True)
 
-    # Need this to calculate the initial residuals
-    f0 = _model(parameters, adjusted_data, depths, ref_temp, ref_cond, 
-                ref_depth)
-    
-    data_jac = _data_jacobian(parameters, adjusted_data, ref_depth)
-    
-    param_jac = _param_jacobian(parameters, adjusted_data, depths, ref_temp, 
-                                ref_cond, ref_depth)
 
-    # Also need to calculate the Lagrange multiplier
-    system = numpy.dot(data_jac, data_jac.T)
-    
-    lagrange_mult = numpy.linalg.solve(system, f0)
+def invert_joint_profiles(problems, temps, error, initial_radheat,
+                          initial_condvar, initial_flux, shared=('condvar',),
+                          max_it=50):
+    """
+    Invert many temperature profiles together with some parameters shared by
+    all of them (e.g., profiles from the same tectonic province).
 
-    residuals = -1*numpy.dot(data_jac.T, lagrange_mult)
-    
-    # Since there is no regularization, the goal function is just the rms
-    rms = (residuals*residuals).sum()
-    goals.append(rms)
+    The normal equations have a block for the shared parameters and one block
+    per profile for the others. The per-profile blocks are eliminated with the
+    Schur complement so the cost grows linearly with the number of profiles.
+
+    Parameters:
+
+    * problems
+        List of *SubcrustProblem* with the depths and reference values of each
+        profile
+
+    * temps
+        List with the temperatures of each profile
+
+    * error
+        Error level in the data
+
+    * initial_radheat, initial_condvar, initial_flux
+        Initial estimates (the same for all profiles)
+
+    * shared
+        Names of the parameters that are the same in all profiles. Any of
+        'radheat', 'condvar' and 'flux'. The others are estimated for each
+        profile.
+
+    * max_it
+        Maximum iterations
+
+    Returns:
+
+    * list with [estimates, cov, adjusted, goals]
+        *estimates* is an array with one [radheat, condvar, flux] per profile
+        (the shared parameters are equal in all).
+        *cov* is the covariance matrix of the shared parameters.
+        *adjusted* is a list with the adjusted data of each profile.
+        *goals* is a list with the goal function value per iteration
+    """
+
+    names = ['radheat', 'condvar', 'flux']
+
+    glob = [names.index(name) for name in shared]
+
+    local = [i for i in xrange(3) if i not in glob]
+
+    nprofiles = len(problems)
+
+    estimates = numpy.empty((nprofiles, 3))
+
+    estimates[:] = [initial_radheat, initial_condvar, initial_flux]
+
+    temps = [numpy.asarray(profile, dtype='f8') for profile in temps]
+
+    adjusted = [numpy.copy(profile) for profile in temps]
+
+    normal = numpy.empty((nprofiles, 3, 3))
 
-    # So that I can warn the user if exited because of max_it and not because of
-    # convergence
-    max_it_exit = True
+    gradient = numpy.empty((nprofiles, 3))
+
+    goals = []
 
     for iteration in xrange(max_it):
 
-        start = time.time()
-        
-        f0 = _model(parameters, adjusted_data, depths, ref_temp, ref_cond, 
-                    ref_depth)
-        
-        data_jac = _data_jacobian(parameters, adjusted_data, ref_depth)
-        
-        param_jac = _param_jacobian(parameters, adjusted_data, depths, ref_temp, 
-                                    ref_cond, ref_depth)
+        # Build the normal equations of each profile
+        for i, problem in enumerate(problems):
 
-        data_jac_inv = numpy.linalg.inv(numpy.dot(data_jac, data_jac.T))
+            param_jac = problem.jacobian(adjusted[i])
 
-        aux = numpy.dot(param_jac.T, data_jac_inv)
+            data_jac = problem.data_jacobian(estimates[i], adjusted[i])
 
-        # Solve for the correction, lagrange multiplier and residuals
-        normal_eq_sys = numpy.dot(aux, param_jac) + 0*numpy.identity(3)
-        
-        normal_eq_sys_inv = numpy.linalg.inv(normal_eq_sys)
-                
-        correction = -1*numpy.dot(numpy.dot(normal_eq_sys_inv, aux), f0)
+            f0 = problem.forward(estimates[i], adjusted[i])
 
-        misfit = numpy.dot(param_jac, correction) + f0
+            # Measure the residuals from the observed data (see invert)
+            scratch = numpy.subtract(temps[i], adjusted[i], problem._misfit)
 
-        lagrange_mult = numpy.dot(data_jac_inv, misfit)
+            scratch *= data_jac
 
-        residuals = -1*numpy.dot(data_jac.T, lagrange_mult)
-        
-        # Update the initial data and parameters
-        adjusted_data += residuals
-        
-        parameters += correction
-        
-        cov += normal_eq_sys_inv*error**2
-        
-        rms = (residuals*residuals).sum()
+            f0 += scratch
 
-        goals.append(rms)
+            numpy.multiply(data_jac, data_jac, scratch)
 
-        end = time.time()
-        
-        print "  it %d: RMS=%g (%g s)" % (iteration + 1, rms, end - start)
+            numpy.divide(param_jac, scratch[:,numpy.newaxis],
+                         problem._weighted)
+
+            numpy.dot(problem._weighted.T, param_jac, normal[i])
+
+            numpy.dot(problem._weighted.T, f0, gradient[i])
+
+        # Eliminate the per-profile blocks (Schur complement)
+        correction = numpy.empty((nprofiles, 3))
 
-        if abs(residuals).max() <= 10**(-2):
+        normal_gg = normal[:,glob][:,:,glob]
 
-            max_it_exit = False
+        normal_gl = normal[:,glob][:,:,local]
+
+        normal_ll = normal[:,local][:,:,local]
+
+        if local:
+
+            solved_lg = numpy.linalg.solve(normal_ll,
+                                           normal_gl.transpose((0, 2, 1)))
+
+            solved_l = numpy.linalg.solve(normal_ll,
+                                          gradient[:,local][:,:,numpy.newaxis])
+
+        if glob:
+
+            schur = normal_gg.sum(axis=0)
+
+            rhs = -gradient[:,glob].sum(axis=0)
+
+            if local:
+
+                schur -= numpy.einsum('pij,pjk->ik', normal_gl, solved_lg)
+
+                rhs += numpy.einsum('pij,pj->i', normal_gl, solved_l[:,:,0])
+
+            correction[:,glob] = numpy.linalg.solve(schur, rhs)
+
+        if local:
+
+            correction[:,local] = -solved_l[:,:,0]
+
+            if glob:
+
+                correction[:,local] -= numpy.einsum('pij,j->pi', solved_lg,
+                                                    correction[0,glob])
+
+        # Update the adjusted data of each profile
+        rms = 0
+
+        largest = 0
+
+        for i, problem in enumerate(problems):
+
+            param_jac = problem.jacobian(adjusted[i])
+
+            data_jac = problem.data_jacobian(estimates[i], adjusted[i])
+
+            misfit = problem.forward(estimates[i], adjusted[i])
+
+            scratch = numpy.subtract(temps[i], adjusted[i], problem._misfit)
+
+            scratch *= data_jac
+
+            misfit += scratch
+
+            misfit += numpy.dot(param_jac, correction[i], scratch)
+
+            residuals = numpy.divide(misfit, data_jac, problem._residuals)
+
+            residuals *= -1
+
+            residuals += temps[i]
+
+            residuals -= adjusted[i]
+
+            largest = max(largest, residuals.max(), -residuals.min())
+
+            adjusted[i] += residuals
+
+            residuals = numpy.subtract(adjusted[i], temps[i], residuals)
+
+            rms += numpy.dot(residuals, residuals)
+
+        estimates += correction
+
+        goals.append(rms)
+
+        if largest <= 10**(-2):
 
             break
 
-    if max_it_exit:
+    cov = numpy.zeros((len(glob), len(glob)))
 
-        print "WARNING! Exited due to reaching maximum number of iterations."
-    
-    results = [parameters[0], parameters[1], parameters[2], cov, adjusted_data,
-               goals]
+    if glob:
+
+        cov = numpy.linalg.inv(schur)*error**2
 
-    return results
+    return [estimates, cov, adjusted, goals]
 
 
 def synthetic_temp_profile(depths, radheat, condvar, ref_flux, ref_temp,
@@ -262,26 +636,671 @@ def synthetic_temp_profile(depths, radheat, condvar, ref_flux, ref_temp,
         Temperatures at the given *depths*
     """
     
-    estimate = [radheat, condvar, ref_flux]
+    problem = SubcrustProblem(depths, ref_temp, ref_cond, ref_depth)
 
-    # Start a little above the reference temperature
-    next = (ref_temp)*numpy.ones_like(depths)
-    
-    # Use Newton's method to find the root of the model equation
-    for i in xrange(500):
-        
-        prev = next
-        
-        f0 = _model(estimate, prev, depths, ref_temp, ref_cond, ref_depth)
-        
-        jacobian = _data_jacobian(estimate, prev, ref_temp)
-        
-        correction = numpy.linalg.solve(jacobian, -1*f0)
-        
-        next = prev + correction
-                
-        if abs(correction).max() <= 0.1:
-            
-            break
-    
-    return next
\ No newline at end of file
+    return problem.synthetic(radheat, condvar, ref_flux)
+
+
+class IncrementalInversion(object):
+    """
+    Inversion of a temperature profile that is updated as new data arrive.
+
+    The model is linear in the parameters once the data Jacobian is fixed, so
+    the normal equations are a sum of terms from each group of appended data.
+    The terms of each group are kept and only recalculated (linearizing at
+    the current estimate) when the estimate has changed enough to move its
+    adjusted data by more than *tol* times the error. Once the estimate
+    settles, appending costs about as much as the new data. Call *iterate*
+    to recalculate all the terms.
+
+    The misclosure of each datum includes the difference between the
+    adjusted and observed temperatures, so the adjusted data are always
+    measured from the observations (as in a Gauss-Helmert adjustment).
+
+    The data, the terms that depend only on depth (as in *SubcrustProblem*)
+    and what is kept of each group are stored in arrays that grow as needed,
+    so new data are appended in place.
+
+    Parameters:
+
+    * error
+        Error level in the data
+
+    * initial_radheat, initial_condvar, initial_flux
+        Initial estimates used before any data arrive (see
+        *invert_temp_profile*)
+
+    * ref_temp, ref_cond, ref_depth
+        Temperature, conductivity and depth of the reference surface
+
+    * tol
+        Recalculate the terms of a group of data if the change of the
+        estimate since they were calculated can move its adjusted data by
+        more than this times the error
+
+    Example::
+
+        inversion = IncrementalInversion(15, 10**(-9), 10**(-4), 10**(-3),
+                                         crust_temp, 3.0, crust_depth)
+        for depths, temps in new_logs:
+            inversion.append(depths, temps)
+            radheat, condvar, flux = inversion.parameters
+    """
+
+    # Number of values in the terms of the normal equations of a group:
+    # J.T*W*J, J.T*W*K, J.T*W*b, K.T*W*K, K.T*W*b and b.T*W*b (see _linearize)
+    _nterms = 34
+
+    def __init__(self, error, initial_radheat, initial_condvar, initial_flux,
+                 ref_temp, ref_cond, ref_depth, tol=1.):
+
+        self.error = error
+        self.ref_temp = ref_temp
+        self.ref_cond = ref_cond
+        self.ref_depth = ref_depth
+        self.tol = tol
+        self.parameters = numpy.array([initial_radheat, initial_condvar,
+                                       initial_flux], dtype='f8')
+        self.goals = []
+        self.ndata = 0
+        self.ngroups = 0
+        # Normal equation system (J.T*W*J) of all the data
+        self.normal = numpy.zeros((3,3))
+        # Data and the terms of the model that only depend on depth
+        self._depths = numpy.empty(0)
+        self._temps = numpy.empty(0)
+        self._adjusted = numpy.empty(0)
+        self._radheat_term = numpy.empty(0)
+        self._flux_term = numpy.empty(0)
+        # Index of the first datum of each group (and one past the last)
+        self._bounds = numpy.zeros(1, dtype='i8')
+        # Of each group: estimate at which its terms were calculated, range of
+        # depths (from the reference), bounds on the data Jacobian and the
+        # condvar column of the Jacobian and the terms
+        self._estimates = numpy.empty((0, 3))
+        self._offsets = numpy.empty((0, 2))
+        self._min_data_jac = numpy.empty(0)
+        self._max_condvar_jac = numpy.empty(0)
+        self._terms = numpy.empty((0, self._nterms))
+        # Sum of the terms of all groups of data
+        self._totals = numpy.zeros(self._nterms)
+
+    def _reserve(self, ndata, ngroups):
+        """
+        Grow the arrays (at least doubling them) to fit *ndata* data and
+        *ngroups* groups.
+        """
+
+        if ndata > len(self._temps):
+
+            size = max(ndata, 2*len(self._temps))
+
+            for name in ['_depths', '_temps', '_adjusted', '_radheat_term',
+                         '_flux_term']:
+
+                grown = numpy.empty(size)
+
+                grown[:self.ndata] = getattr(self, name)[:self.ndata]
+
+                setattr(self, name, grown)
+
+        if ngroups > len(self._estimates):
+
+            size = max(ngroups, 2*len(self._estimates))
+
+            for name in ['_bounds', '_estimates', '_offsets', '_min_data_jac',
+                         '_max_condvar_jac', '_terms']:
+
+                old = getattr(self, name)
+
+                grown = numpy.zeros((size + (name == '_bounds'),) +
+                                    old.shape[1:], dtype=old.dtype)
+
+                grown[:len(old)] = old
+
+                setattr(self, name, grown)
+
+    @property
+    def depths(self):
+
+        return self._depths[:self.ndata]
+
+    @property
+    def temps(self):
+
+        return self._temps[:self.ndata]
+
+    @property
+    def adjusted(self):
+        """
+        Adjusted data at the current estimate.
+        """
+
+        return self._adjust(self._temps[:self.ndata],
+                            self._adjusted[:self.ndata],
+                            self._radheat_term[:self.ndata],
+                            self._flux_term[:self.ndata])
+
+    @property
+    def covariance(self):
+
+        return numpy.linalg.inv(self.normal)*self.error**2
+
+    @property
+    def gradient(self):
+        """
+        Gradient of the goal function (over 2) at the current estimate.
+        """
+
+        return (numpy.dot(self._totals[9:18].reshape((3, 3)), self.parameters)
+                + self._totals[18:21])
+
+    def _adjust(self, temps, adjusted, radheat_term, flux_term):
+        """
+        Adjusted data at the current estimate, given the data at which they
+        were linearized. The misclosure includes D*(temps - adjusted).
+        """
+
+        radheat, condvar, flux = self.parameters
+
+        diffs = adjusted - self.ref_temp
+
+        data_jac = 1 + condvar*diffs
+
+        misclosure = diffs*(1 + 0.5*condvar*diffs)
+
+        misclosure += radheat*radheat_term + flux*flux_term
+
+        misclosure += data_jac*(temps - adjusted)
+
+        return temps - misclosure/data_jac
+
+    def _linearize(self, groups):
+        """
+        Calculate the terms of the normal equations of the groups of data in
+        the (increasing) array *groups* at the current estimate.
+        """
+
+        starts = self._bounds[groups]
+
+        lengths = self._bounds[groups + 1] - starts
+
+        # Position of each group in the stacked data of the groups
+        positions = numpy.cumsum(lengths) - lengths
+
+        index = (numpy.arange(lengths.sum()) +
+                 numpy.repeat(starts - positions, lengths))
+
+        temps = self._temps[index]
+
+        radheat_term = self._radheat_term[index]
+
+        flux_term = self._flux_term[index]
+
+        adjusted = self._adjust(temps, self._adjusted[index], radheat_term,
+                                flux_term)
+
+        self._adjusted[index] = adjusted
+
+        diffs = adjusted - self.ref_temp
+
+        data_jac = 1 + self.parameters[1]*diffs
+
+        jacobian = numpy.column_stack([radheat_term, 0.5*diffs**2,
+                                       flux_term])
+
+        # The misclosure is linear in the parameters: b + K*parameters
+        linear = numpy.copy(jacobian)
+
+        linear[:,1] += (temps - adjusted)*diffs
+
+        constant = temps - self.ref_temp
+
+        weights = 1./data_jac**2
+
+        weighted = jacobian*weights[:,numpy.newaxis]
+
+        weighted_linear = linear*weights[:,numpy.newaxis]
+
+        terms = numpy.empty((len(index), self._nterms))
+
+        terms[:,:9] = (weighted[:,:,numpy.newaxis]*
+                       jacobian[:,numpy.newaxis,:]).reshape((-1, 9))
+
+        terms[:,9:18] = (weighted[:,:,numpy.newaxis]*
+                         linear[:,numpy.newaxis,:]).reshape((-1, 9))
+
+        terms[:,18:21] = weighted*constant[:,numpy.newaxis]
+
+        terms[:,21:30] = (weighted_linear[:,:,numpy.newaxis]*
+                          linear[:,numpy.newaxis,:]).reshape((-1, 9))
+
+        terms[:,30:33] = weighted_linear*constant[:,numpy.newaxis]
+
+        terms[:,33] = weights*constant**2
+
+        terms = numpy.add.reduceat(terms, positions)
+
+        self._totals += terms.sum(axis=0) - self._terms[groups].sum(axis=0)
+
+        self._terms[groups] = terms
+
+        self._estimates[groups] = self.parameters
+
+        self._min_data_jac[groups] = numpy.minimum.reduceat(abs(data_jac),
+                                                            positions)
+
+        self._max_condvar_jac[groups] = numpy.maximum.reduceat(
+            abs(jacobian[:,1]), positions)
+
+    def _solve(self):
+        """
+        Solve the normal equations of all the data for the estimate.
+        """
+
+        totals = self._totals
+
+        self.normal = totals[:9].reshape((3, 3))
+
+        linear2 = totals[21:30].reshape((3, 3))
+
+        self.parameters = numpy.linalg.solve(totals[9:18].reshape((3, 3)),
+                                             -totals[18:21])
+
+        # Sum of the squared residuals, without touching the data
+        self.goals.append(numpy.dot(self.parameters,
+                                    numpy.dot(linear2, self.parameters)) +
+                          2*numpy.dot(self.parameters, totals[30:33]) +
+                          totals[33])
+
+    def _stale(self):
+        """
+        Get the groups of data whose terms need to be recalculated: those
+        whose adjusted data could move by more than *tol* times the error if
+        linearized at the current estimate.
+        """
+
+        ngroups = self.ngroups
+
+        changes = self.parameters - self._estimates[:ngroups]
+
+        offsets = self._offsets[:ngroups]
+
+        # The radheat and flux columns are a quadratic in depth, so their
+        # largest change is at the ends of the range or at the vertex
+        square = changes[:,0]/(2.*self.ref_cond)
+
+        linear = -changes[:,2]/self.ref_cond
+
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+
+            vertex = numpy.where(square != 0, -linear/(2*square), 0)
+
+        vertex = numpy.clip(vertex, offsets[:,0], offsets[:,1])
+
+        largest = abs(square*offsets[:,0]**2 + linear*offsets[:,0])
+
+        for offset in [offsets[:,1], vertex]:
+
+            numpy.maximum(largest, abs(square*offset**2 + linear*offset),
+                          largest)
+
+        largest += abs(changes[:,1])*self._max_condvar_jac[:ngroups]
+
+        largest /= self._min_data_jac[:ngroups]
+
+        return numpy.flatnonzero(largest > self.tol*self.error)
+
+    def append(self, depths, temps, iterations=10):
+        """
+        Add new data to the profile and update the estimate.
+
+        Only the new data and the groups of old data whose terms are stale
+        (see *tol*) are linearized again. Empty data are ignored.
+
+        Parameters:
+
+        * depths, temps
+            The new data
+
+        * iterations
+            Maximum number of times to update the stale terms
+
+        Returns:
+
+        * parameters
+            The updated [radheat, condvar, flux]
+        """
+
+        depths = numpy.asarray(depths, dtype='f8').ravel()
+
+        temps = numpy.asarray(temps, dtype='f8').ravel()
+
+        if len(depths) != len(temps):
+
+            raise ValueError("depths and temps must have the same length")
+
+        if not len(depths):
+
+            return self.parameters
+
+        start, end = self.ndata, self.ndata + len(depths)
+
+        group = self.ngroups
+
+        self._reserve(end, group + 1)
+
+        self._depths[start:end] = depths
+
+        self._temps[start:end] = temps
+
+        self._adjusted[start:end] = temps
+
+        offsets = numpy.subtract(depths, self.ref_depth,
+                                 self._flux_term[start:end])
+
+        self._radheat_term[start:end] = offsets**2/(2*self.ref_cond)
+
+        self._offsets[group] = [offsets.min(), offsets.max()]
+
+        offsets /= -self.ref_cond
+
+        self._bounds[group + 1] = end
+
+        self.ndata, self.ngroups = end, group + 1
+
+        self._linearize(numpy.array([group]))
+
+        if self.ndata < 3:
+
+            return self.parameters
+
+        self._solve()
+
+        for iteration in xrange(iterations):
+
+            stale = self._stale()
+
+            if not len(stale):
+
+                break
+
+            self._linearize(stale)
+
+            self._solve()
+
+        return self.parameters
+
+    def iterate(self, iterations):
+        """
+        Linearize all the data at the current estimate and solve again.
+        Stops early if no group of data is stale (see *tol*).
+
+        Parameters:
+
+        * iterations
+            Maximum number of iterations to run
+
+        Returns:
+
+        * parameters
+            The updated [radheat, condvar, flux]
+        """
+
+        groups = numpy.arange(self.ngroups)
+
+        for iteration in xrange(iterations):
+
+            self._linearize(groups)
+
+            # Sum the terms again to drop the round-off of the updates
+            self._totals = self._terms[:self.ngroups].sum(axis=0)
+
+            self._solve()
+
+            if not len(self._stale()):
+
+                break
+
+        return self.parameters
+
+
+# Data of the posterior evaluated by the worker processes of sample_posterior
+_posterior = {}
+
+
+def _log_posterior(estimates, problem, temps, error, bounds):
+    """
+    Logarithm of the posterior probability (up to a constant) of each row of
+    *estimates*. Uniform priors inside *bounds*.
+    """
+
+    logprob = numpy.zeros(len(estimates)) - numpy.inf
+
+    inside = numpy.ones(len(estimates), dtype='bool')
+
+    if bounds is not None:
+
+        for i, (lower, upper) in enumerate(bounds):
+
+            inside &= (estimates[:,i] >= lower) & (estimates[:,i] <= upper)
+
+    if inside.any():
+
+        predicted = problem.synthetic_many(estimates[inside])
+
+        residuals = (temps - predicted)/error
+
+        misfit = -0.5*(residuals**2).sum(axis=1)
+
+        misfit[numpy.isnan(misfit)] = -numpy.inf
+
+        logprob[inside] = misfit
+
+    return logprob
+
+
+def _setup_worker(problem, temps, error, bounds):
+    """
+    Keep the data of the posterior in the worker process.
+    """
+
+    _posterior['args'] = (problem, temps, error, bounds)
+
+
+def _log_posterior_worker(estimates):
+    """
+    Evaluate *_log_posterior* in a worker process.
+    """
+
+    return _log_posterior(estimates, *_posterior['args'])
+
+
+def sample_posterior(problem, temps, error, initial, nwalkers=32,
+                     nsteps=1000, scatter=0.01, bounds=None, processes=None,
+                     storage=None, chunksize=100, stretch=2., seed=None):
+    """
+    Sample the posterior distribution of the radiogenic heat generation,
+    conductivity variation and heat flux of a temperature profile.
+
+    Uses the affine-invariant ensemble sampler of Goodman & Weare (2010) with
+    stretch moves. The forward models of all walkers being moved are
+    calculated in a single vectorized call (see
+    *SubcrustProblem.synthetic_many*), optionally split among processes.
+
+    Parameters:
+
+    * problem
+        *SubcrustProblem* with the depths and reference values
+
+    * temps
+        The measured temperatures
+
+    * error
+        Error level (standard deviation) in the data
+
+    * initial
+        [radheat, condvar, flux] around which the walkers start (e.g., the
+        result of *invert_temp_profile*)
+
+    * nwalkers
+        Number of walkers (even and at least 6)
+
+    * nsteps
+        Number of steps of each walker
+
+    * scatter
+        Relative spread of the walkers around *initial*
+
+    * bounds
+        List with [lower, upper] bounds of each parameter (uniform priors).
+        If None, the priors are flat.
+
+    * processes
+        Number of processes used to calculate the forward models. If None,
+        uses the current process only.
+
+    * storage
+        Directory where the chain and log posterior are saved as
+        'chain.npy' and 'logprob.npy'. They are written in chunks so memory
+        use doesn't grow with *nsteps*. If None, kept in memory.
+
+    * chunksize
+        Number of steps kept in memory before writing to *storage*
+
+    * stretch
+        Scale parameter of the stretch move
+
+    * seed
+        Seed for the random number generator
+
+    Returns:
+
+    * list with [chain, logprob, acceptance]
+        *chain* is an array with shape (nsteps, nwalkers, 3),
+        *logprob* the log posterior of each sample with shape
+        (nsteps, nwalkers) (memory-mapped if *storage* is given) and
+        *acceptance* the fraction of accepted moves of each walker
+    """
+
+    if nwalkers % 2 or nwalkers < 6:
+
+        raise ValueError("nwalkers must be even and at least 6")
+
+    random = numpy.random.RandomState(seed)
+
+    temps = numpy.asarray(temps, dtype='f8')
+
+    if processes is None:
+
+        def logpost(estimates):
+
+            return _log_posterior(estimates, problem, temps, error, bounds)
+
+    else:
+
+        # Only needed for parallel sampling, so it's not imported with the
+        # module
+        import multiprocessing
+
+        pool = multiprocessing.Pool(processes, _setup_worker,
+                                    (problem, temps, error, bounds))
+
+        def logpost(estimates):
+
+            parts = numpy.array_split(estimates, processes)
+
+            return numpy.concatenate(pool.map(_log_posterior_worker, parts))
+
+    if storage is None:
+
+        chain = numpy.empty((nsteps, nwalkers, 3))
+
+        logprob = numpy.empty((nsteps, nwalkers))
+
+    else:
+
+        if not os.path.isdir(storage):
+
+            os.makedirs(storage)
+
+        chain = numpy.lib.format.open_memmap(os.path.join(storage,
+            'chain.npy'), mode='w+', dtype='f8', shape=(nsteps, nwalkers, 3))
+
+        logprob = numpy.lib.format.open_memmap(os.path.join(storage,
+            'logprob.npy'), mode='w+', dtype='f8', shape=(nsteps, nwalkers))
+
+    chunk_chain = numpy.empty((chunksize, nwalkers, 3))
+
+    chunk_logprob = numpy.empty((chunksize, nwalkers))
+
+    initial = numpy.asarray(initial, dtype='f8')
+
+    spread = scatter*numpy.where(initial != 0, abs(initial), 1)
+
+    walkers = initial + spread*random.normal(size=(nwalkers, 3))
+
+    current = logpost(walkers)
+
+    accepted = numpy.zeros(nwalkers)
+
+    halves = [numpy.arange(nwalkers//2), numpy.arange(nwalkers//2, nwalkers)]
+
+    try:
+
+        for step in xrange(nsteps):
+
+            # Move each half of the ensemble using the other half
+            for moving, others in [halves, halves[::-1]]:
+
+                size = len(moving)
+
+                stretches = ((stretch - 1)*random.uniform(size=size) +
+                             1)**2/stretch
+
+                partners = walkers[others[random.randint(size, size=size)]]
+
+                proposals = partners + stretches[:,numpy.newaxis]*(
+                    walkers[moving] - partners)
+
+                proposed = logpost(proposals)
+
+                with numpy.errstate(invalid='ignore'):
+
+                    accept = (2*numpy.log(stretches) + proposed -
+                              current[moving] >
+                              numpy.log(random.uniform(size=size)))
+
+                walkers[moving[accept]] = proposals[accept]
+
+                current[moving[accept]] = proposed[accept]
+
+                accepted[moving[accept]] += 1
+
+            chunk_chain[step % chunksize] = walkers
+
+            chunk_logprob[step % chunksize] = current
+
+            if (step + 1) % chunksize == 0 or step + 1 == nsteps:
+
+                start = step - step % chunksize
+
+                chain[start:step + 1] = chunk_chain[:step + 1 - start]
+
+                logprob[start:step + 1] = chunk_logprob[:step + 1 - start]
+
+    finally:
+
+        if processes is not None:
+
+            pool.close()
+
+            pool.join()
+
+    if storage is not None:
+
+        chain.flush()
+
+        logprob.flush()
+
+    return [chain, logprob, accepted/nsteps]
@@ -8,16 +8,17 @@ import numpy
 import pylab
 
 import geothermics.subcrust as subcrust
+import geothermics.catalogue as catalogue
 
 # Define the model parameters
 conductivity = 3.0          # [W/(m K)]
 crust_temp = 461 + 273.    # temperature at the base of the crust [K]
 crust_depth = 35*10**3      # depth of the base of the crust [m]
 
-depths, temps = pylab.loadtxt('dados.txt', unpack=True)
+depths, temps = catalogue.load('dados.txt').profile(0)
 
-temps += 273.
-depths *= 1000
+temps = temps + 273.
+depths = depths*1000
 
 print "Read %d data" % (len(temps))
 
@@ -0,0 +1,165 @@
+"""
+Check the adjoint gradient of adjoint1d against finite differences of the
+misfit of 'diffusionfd1d.run'.
+
+Usage: PYTHONPATH=. python tests/test_adjoint1d.py
+"""
+
+import unittest
+
+import numpy
+
+from geothermics import adjoint1d, diffusionfd1d
+
+
+class GradientTestCase(unittest.TestCase):
+
+    def setUp(self):
+
+        random = numpy.random.RandomState(0)
+
+        self.nodes = 12
+
+        self.diffusivity = 0.4 + 0.4*random.rand(self.nodes)
+
+        self.initial = 10*random.rand(self.nodes)
+
+        self.coordinates = numpy.cumsum(numpy.r_[0, 0.9 +
+                                                 0.2*random.rand(11)])
+
+        self.obs_steps = [0, 10, 25, 40]
+
+        self.obs_nodes = [1, 4, 7, 10]
+
+        self.data = 5 + random.rand(len(self.obs_steps), len(self.obs_nodes))
+
+        self.cases = [[1., diffusionfd1d.fixed_bc(2, 5)],
+                      [1., diffusionfd1d.free_bc()],
+                      [self.coordinates,
+                       [diffusionfd1d.temperature_bc([0, 5, 20], [0, 3, 1],
+                                                     'start'),
+                        diffusionfd1d.flux_bc([0, 30], [0.2, -0.1], 'end',
+                                              2.)]]]
+
+    def _misfit(self, deltax, diffusivity, initial, start_bc, end_bc):
+
+        misfit = 0.
+
+        for step, data in zip(self.obs_steps, self.data):
+
+            temps = diffusionfd1d.run(deltax, 0.2, diffusivity, initial,
+                                      start_bc, end_bc, step)
+
+            misfit += 0.5*((temps[self.obs_nodes] - data)**2).sum()/0.5**2
+
+        return misfit
+
+    def _gradient(self, deltax, start_bc, end_bc, checkpoint=None):
+
+        return adjoint1d.misfit_gradient(deltax, 0.2, self.diffusivity,
+            self.initial, start_bc, end_bc, 40, self.obs_steps,
+            self.obs_nodes, self.data, 0.5, checkpoint)
+
+    def test_finite_differences(self):
+
+        step = 10**(-6)
+
+        for deltax, (start_bc, end_bc) in self.cases:
+
+            misfit, grad_diffusivity, grad_initial = self._gradient(deltax,
+                start_bc, end_bc)
+
+            self.assertAlmostEqual(misfit, self._misfit(deltax,
+                self.diffusivity, self.initial, start_bc, end_bc), 8)
+
+            for node in xrange(self.nodes):
+
+                for params, gradient, diffusivity in [
+                        [self.diffusivity, grad_diffusivity, True],
+                        [self.initial, grad_initial, False]]:
+
+                    forward, backward = numpy.copy(params), numpy.copy(params)
+
+                    forward[node] += step
+
+                    backward[node] -= step
+
+                    if diffusivity:
+
+                        goals = [self._misfit(deltax, p, self.initial,
+                                              start_bc, end_bc)
+                                 for p in [forward, backward]]
+
+                    else:
+
+                        goals = [self._misfit(deltax, self.diffusivity, p,
+                                              start_bc, end_bc)
+                                 for p in [forward, backward]]
+
+                    estimate = (goals[0] - goals[1])/(2*step)
+
+                    self.assertTrue(abs(estimate - gradient[node]) <
+                                    10**(-5)*max(1, abs(estimate)),
+                                    "node %d: %g != %g" % (node, estimate,
+                                                           gradient[node]))
+
+    def test_checkpoint(self):
+
+        for deltax, (start_bc, end_bc) in self.cases:
+
+            expected = self._gradient(deltax, start_bc, end_bc, 40)
+
+            for checkpoint in [1, 3, 7]:
+
+                result = self._gradient(deltax, start_bc, end_bc, checkpoint)
+
+                self.assertAlmostEqual(result[0], expected[0], 10)
+
+                for grad, grad_expected in zip(result[1:], expected[1:]):
+
+                    self.assertTrue(abs(grad - grad_expected).max() <
+                                    10**(-10)*abs(grad_expected).max())
+
+    def test_invert(self):
+
+        start_bc, end_bc = diffusionfd1d.fixed_bc(2, 5)
+
+        data = [diffusionfd1d.run(1., 0.2, self.diffusivity, self.initial,
+                                  start_bc, end_bc, step)[self.obs_nodes]
+                for step in self.obs_steps]
+
+        # Exact data and estimate: a zero gradient, nothing to do
+        diffusivity, initial, goals = adjoint1d.invert(1., 0.2,
+            self.diffusivity, self.initial, start_bc, end_bc, 40,
+            self.obs_steps, self.obs_nodes, data, max_it=5)
+
+        self.assertTrue((diffusivity == self.diffusivity).all())
+
+        self.assertEqual(goals, [0.])
+
+        diffusivity, initial, goals = adjoint1d.invert(1., 0.2,
+            numpy.ones(self.nodes)*0.6, self.initial, start_bc, end_bc, 40,
+            self.obs_steps, self.obs_nodes, data, max_it=30)
+
+        self.assertTrue(goals[-1] < 10**(-2)*goals[0])
+
+    def test_no_observations(self):
+
+        start_bc, end_bc = diffusionfd1d.fixed_bc(2, 5)
+
+        misfit, grad_diffusivity, grad_initial = adjoint1d.misfit_gradient(
+            1., 0.2, self.diffusivity, self.initial, start_bc, end_bc, 40,
+            [], [], [])
+
+        self.assertEqual(misfit, 0)
+
+        self.assertFalse(grad_diffusivity.any() or grad_initial.any())
+
+        self.assertRaises(ValueError, adjoint1d.misfit_gradient, 1., 0.2,
+                          self.diffusivity, self.initial, start_bc, end_bc,
+                          40, [10, 5], self.obs_nodes, self.data[:2])
+
+
+if __name__ == '__main__':
+
+    unittest.main()
@@ -0,0 +1,145 @@
+"""
+Check that catalogue groups the profiles by site and keeps its cache in step
+with the file and the parsing options.
+
+Usage: PYTHONPATH=. python tests/test_catalogue.py
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+from geothermics import catalogue
+
+
+class LoadTestCase(unittest.TestCase):
+
+    def setUp(self):
+
+        self.path = tempfile.mkdtemp()
+
+        self.fname = os.path.join(self.path, 'catalogue.txt')
+
+        self.lines = ['# depth temp site',
+                      '10 15.5 A', '10 16.0 B', '20 17.5 A', '', '30 19.0 A',
+                      '# end of day 1', '20 18.5 B', '5 12.0 C']
+
+        self._write(self.lines)
+
+    def tearDown(self):
+
+        shutil.rmtree(self.path)
+
+    def _write(self, lines):
+
+        output = open(self.fname, 'w')
+
+        output.write('\n'.join(lines) + '\n')
+
+        output.close()
+
+    def test_grouping(self):
+
+        for chunksize in [1, 3, 100]:
+
+            data = catalogue.load(self.fname, cache=False,
+                                  chunksize=chunksize)
+
+            self.assertEqual(data.sites, ['A', 'B', 'C'])
+
+            self.assertEqual(list(data.offsets), [0, 3, 5, 6])
+
+            depths, temps = data.profile(data.index('A'))
+
+            self.assertEqual(list(depths), [10, 20, 30])
+
+            self.assertEqual(list(temps), [15.5, 17.5, 19.0])
+
+            self.assertEqual([site for site, depths, temps in
+                              data.profiles()], data.sites)
+
+        self.assertEqual(os.listdir(self.path), ['catalogue.txt'])
+
+    def test_cache(self):
+
+        first = catalogue.load(self.fname)
+
+        cache = os.path.join(self.path, 'catalogue.txt.cache')
+
+        self.assertEqual(sorted(os.listdir(cache)),
+                         sorted(name + '.npy' for name in
+                                ['depths', 'temps', 'offsets', 'sites',
+                                 'source']))
+
+        second = catalogue.load(self.fname)
+
+        self.assertTrue(isinstance(second.depths, numpy.memmap))
+
+        self.assertEqual(list(second.temps), list(first.temps))
+
+        # The cache of the whole file must not be used with other options
+        skipped = catalogue.load(self.fname, skiprows=3)
+
+        self.assertEqual(skipped.sites, ['A', 'B', 'C'])
+
+        self.assertEqual(list(skipped.offsets), [0, 2, 3, 4])
+
+        self.assertEqual(list(catalogue.load(self.fname).offsets),
+                         [0, 3, 5, 6])
+
+    def test_delimiter(self):
+
+        self._write(['10, 15.5, Site one', '20, 16.0, Site two',
+                     '30, 17.5, Site one'])
+
+        data = catalogue.load(self.fname, delimiter=',')
+
+        self.assertEqual(data.sites, ['Site one', 'Site two'])
+
+        self.assertEqual(list(data.profile(0)[0]), [10, 30])
+
+        self.assertRaises(ValueError, catalogue.load, self.fname,
+                          cache=False)
+
+    def test_no_sites(self):
+
+        self._write(['10 15.5', '20 16.0'])
+
+        data = catalogue.load(self.fname)
+
+        self.assertEqual(data.sites, [''])
+
+        self.assertEqual(list(data.offsets), [0, 2])
+
+    def test_empty(self):
+
+        for lines in [[], ['# nothing yet']]:
+
+            self._write(lines)
+
+            data = catalogue.load(self.fname)
+
+            self.assertEqual(len(data), 0)
+
+            self.assertEqual(len(data.depths), 0)
+
+            self.assertEqual(list(data.offsets), [0])
+
+    def test_bad_line(self):
+
+        self._write(self.lines + ['40 20.0'])
+
+        cache = os.path.join(self.path, 'cache')
+
+        self.assertRaises(ValueError, catalogue.load, self.fname, cache=cache,
+                          chunksize=2)
+
+        self.assertEqual(os.listdir(cache), [])
+
+
+if __name__ == '__main__':
+
+    unittest.main()
@@ -0,0 +1,154 @@
+"""
+Check the direct solvers of diffusionfd1d against time stepping and the
+compiled loops of 'run' against stepping in Python.
+
+Usage: PYTHONPATH=. python tests/test_diffusionfd1d.py
+"""
+
+import unittest
+
+import numpy
+
+from geothermics import diffusionfd1d
+
+
+class SolversTestCase(unittest.TestCase):
+
+    def setUp(self):
+
+        random = numpy.random.RandomState(0)
+
+        self.nodes = 30
+
+        self.initial = 10*random.rand(self.nodes)
+
+        self.coordinates = numpy.cumsum(numpy.r_[0, 0.8 +
+                                                 0.4*random.rand(29)])
+
+    def test_spectral(self):
+
+        deltat = 0.001
+
+        diffusivity = numpy.ones(self.nodes)
+
+        for start_bc, end_bc in [diffusionfd1d.fixed_bc(2, 5),
+                                 diffusionfd1d.free_bc()]:
+
+            temps = diffusionfd1d.spectral(1., diffusivity, self.initial,
+                                           start_bc, end_bc, [0, 1, 5])
+
+            for time, expected in zip([0, 1, 5], temps):
+
+                result = diffusionfd1d.run(1., deltat, diffusivity,
+                                           self.initial, start_bc, end_bc,
+                                           int(round(time/deltat)))
+
+                self.assertTrue(abs(result - expected).max() < 10**(-2),
+                                "%s at %g" % (start_bc.kind, time))
+
+    def test_steady_state(self):
+
+        diffusivity = numpy.linspace(0.5, 1, self.nodes)
+
+        cases = [[1., diffusionfd1d.fixed_bc(2, 5)],
+                 [1., [diffusionfd1d.flux_bc([0], [0.3], 'start'),
+                       diffusionfd1d.temperature_bc([0], [7], 'end')]],
+                 [self.coordinates, diffusionfd1d.fixed_bc(-1, 4)]]
+
+        for deltax, (start_bc, end_bc) in cases:
+
+            expected = diffusionfd1d.steady_state(deltax, diffusivity,
+                                                  start_bc, end_bc)
+
+            # Stable time step for the smallest spacing
+            deltat = 0.25*numpy.min(numpy.diff(self.coordinates))**2
+
+            result = diffusionfd1d.run(deltax, deltat, diffusivity,
+                                       self.initial, start_bc, end_bc, 80000)
+
+            self.assertTrue(abs(result - expected).max() < 10**(-6))
+
+    def test_precision_report(self):
+
+        start_bc, end_bc = diffusionfd1d.fixed_bc(0, 100)
+
+        report = diffusionfd1d.precision_report(1., 0.4, 0.5*numpy.ones(
+            self.nodes), 10*self.initial, start_bc, end_bc, 500)
+
+        for precision in ['single', 'mixed']:
+
+            values = report[precision]
+
+            self.assertTrue(0 < values['max_error'] <= values['bound'])
+
+            self.assertTrue(values['rms_error'] <= values['max_error'])
+
+            self.assertEqual(values['bytes'], 4*self.nodes)
+
+    def test_compiled(self):
+
+        diffusivity = numpy.linspace(0.1, 0.4, self.nodes)
+
+        cases = [diffusionfd1d.fixed_bc(2, 5), diffusionfd1d.free_bc(),
+                 [diffusionfd1d.temperature_bc([0, 10, 30], [0, 3, -1],
+                                               'start'),
+                  diffusionfd1d.flux_bc([5, 20], [0.1, -0.2], 'end', 2.)]]
+
+        for start_bc, end_bc in cases:
+
+            for precision in ['double', 'single', 'mixed']:
+
+                steps = diffusionfd1d.run(1., 0.5, diffusivity, self.initial,
+                                          start_bc, end_bc, 100, precision,
+                                          compiled=False)
+
+                compiled = diffusionfd1d.run(1., 0.5, diffusivity,
+                                             self.initial, start_bc, end_bc,
+                                             100, precision)
+
+                self.assertTrue((steps == compiled).all())
+
+                self.assertEqual(steps.dtype, compiled.dtype)
+
+        steps = diffusionfd1d.run(self.coordinates, 0.5, diffusivity,
+                                  self.initial, start_bc, end_bc, 100,
+                                  compiled=False)
+
+        compiled = diffusionfd1d.run(self.coordinates, 0.5, diffusivity,
+                                     self.initial, start_bc, end_bc, 100)
+
+        self.assertTrue((steps == compiled).all())
+
+    def test_profile(self):
+
+        def start_bc(temps):
+
+            temps[0] = 1
+
+        def end_bc(temps):
+
+            temps[-1] = 0
+
+        temps = diffusionfd1d.run(1., 0.5, 0.3*numpy.ones(self.nodes),
+                                  self.initial, start_bc, end_bc, 50)
+
+        profiled, profile = diffusionfd1d.run(1., 0.5, 0.3*numpy.ones(
+            self.nodes), self.initial, start_bc, end_bc, 50, profile=True)
+
+        self.assertTrue((temps == profiled).all())
+
+        self.assertEqual(profile.calls['kernel'], 50)
+
+        self.assertEqual(profile.calls['boundaries'], 51)
+
+    def test_wrong_side(self):
+
+        start_bc, end_bc = diffusionfd1d.fixed_bc(0, 1)
+
+        self.assertRaises(ValueError, diffusionfd1d.run, 1., 0.5,
+                          numpy.ones(5), numpy.zeros(5), end_bc, start_bc, 3)
+
+
+if __name__ == '__main__':
+
+    unittest.main()
@@ -0,0 +1,138 @@
+"""
+Check that the job server runs the jobs like the local functions, shares the
+batches among its workers and reports the failed jobs.
+
+Usage: PYTHONPATH=. python tests/test_jobserver.py
+"""
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import numpy
+
+from geothermics import diffusionfd1d, jobserver
+
+
+def _nap(seconds):
+
+    time.sleep(seconds)
+
+    return os.getpid()
+
+
+# Registered before the server forks its workers
+jobserver.jobs['test.nap'] = _nap
+
+
+class ServerTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+
+        cls.path = tempfile.mkdtemp()
+
+        cls.address = os.path.join(cls.path, 'server')
+
+        cls.process = jobserver.start(cls.address, nworkers=2)
+
+        for i in xrange(100):
+
+            if os.path.exists(cls.address):
+
+                break
+
+            time.sleep(0.05)
+
+    @classmethod
+    def tearDownClass(cls):
+
+        client = jobserver.Client(cls.address)
+
+        client.shutdown()
+
+        cls.process.join(10)
+
+        shutil.rmtree(cls.path)
+
+    def setUp(self):
+
+        self.client = jobserver.Client(self.address)
+
+    def tearDown(self):
+
+        self.client.close()
+
+    def test_map(self):
+
+        initial = numpy.linspace(0, 10, 20)
+
+        arglist = [(1., 0.5, 0.2*numpy.ones(20), initial, ('fixed', 0, 10),
+                    ntimes) for ntimes in [0, 10, 100]]
+
+        arglist.append([(1., 0.5, 0.2*numpy.ones(20), initial,
+                         [('temperature', [0, 50], [0, 5]),
+                          ('flux', [0], [0.1], 2.)], 100),
+                        {'precision':'single'}])
+
+        results = self.client.map('diffusionfd1d.run', arglist)
+
+        for args, result in zip(arglist, results):
+
+            kwargs = {}
+
+            if isinstance(args, list):
+
+                args, kwargs = args
+
+            bcs = jobserver._make_bcs(args[4])
+
+            expected = diffusionfd1d.run(*(args[:4] + tuple(bcs) + args[5:]),
+                                         **kwargs)
+
+            self.assertTrue((result == expected).all())
+
+        result = self.client.result(self.client.submit(
+            'diffusionfd1d.steady_state', 1., numpy.ones(20), ('fixed', 0, 19)))
+
+        self.assertTrue(abs(result - numpy.arange(20)).max() < 10**(-10))
+
+    def test_errors(self):
+
+        jobids = [self.client.submit('diffusionfd1d.steady_state', 1.,
+                                     numpy.ones(5), bcs)
+                  for bcs in [('fixed', 0), ('free',), ('fixed', 0, 1)]]
+
+        try:
+
+            self.client.result(jobids[0])
+
+        except jobserver.JobError, error:
+
+            self.assertTrue('Invalid boundary conditions' in str(error))
+
+        else:
+
+            self.fail("Invalid boundary conditions didn't fail")
+
+        self.assertRaises(jobserver.JobError, self.client.result, jobids[1])
+
+        # The failures don't affect the other jobs
+        self.assertTrue(abs(self.client.result(jobids[2]) -
+                            numpy.linspace(0, 1, 5)).max() < 10**(-10))
+
+        self.assertRaises(jobserver.JobError, self.client.result,
+                          self.client.submit('no.such.job'))
+
+    def test_split(self):
+
+        pids = self.client.map('test.nap', [(0.05,)]*8)
+
+        self.assertEqual(len(set(pids)), 2)
+
+
+if __name__ == '__main__':
+
+    unittest.main()
@@ -0,0 +1,106 @@
+"""
+Check that IncrementalInversion agrees with the batch inversion of
+SubcrustProblem on the same data.
+
+Usage: PYTHONPATH=. python tests/test_subcrust.py
+"""
+
+import os
+import sys
+import unittest
+
+import numpy
+
+from geothermics import subcrust
+
+
+class IncrementalTestCase(unittest.TestCase):
+
+    def setUp(self):
+
+        self.ref = (700., 3., 35000.)
+
+        self.depths = numpy.linspace(35000, 200000, 200)
+
+        temps = subcrust.synthetic_temp_profile(self.depths, 2*10**(-7),
+                                                5*10**(-4), 0.03, *self.ref)
+
+        self.temps = temps + numpy.random.RandomState(0).normal(0, 1,
+                                                                len(temps))
+
+        # The batch inversion prints its progress
+        stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+
+        try:
+
+            self.batch = subcrust.invert_temp_profile(self.depths, self.temps,
+                1., 10**(-7), 10**(-4), 0.02, 700., 3., 35000., max_it=50)
+
+        finally:
+
+            sys.stdout.close()
+
+            sys.stdout = stdout
+
+        self.stddev = numpy.sqrt(numpy.diag(self.batch[3]))
+
+    def _append(self, nchunks):
+
+        inversion = subcrust.IncrementalInversion(1., 10**(-7), 10**(-4),
+                                                  0.02, *self.ref)
+
+        for chunk in numpy.array_split(numpy.arange(len(self.depths)),
+                                       nchunks):
+
+            inversion.append(self.depths[chunk], self.temps[chunk])
+
+        return inversion
+
+    def test_appends(self):
+
+        for nchunks in [1, 5, 40, 200]:
+
+            inversion = self._append(nchunks)
+
+            difference = (inversion.parameters - self.batch[:3])/self.stddev
+
+            self.assertTrue(abs(difference).max() < 0.05,
+                            "%d appends: %s" % (nchunks, difference))
+
+    def test_iterate(self):
+
+        for nchunks in [5, 200]:
+
+            inversion = self._append(nchunks)
+
+            inversion.iterate(20)
+
+            difference = (inversion.parameters - self.batch[:3])/self.stddev
+
+            self.assertTrue(abs(difference).max() < 10**(-4),
+                            "%d appends: %s" % (nchunks, difference))
+
+            self.assertTrue(abs(inversion.adjusted - self.batch[4]).max() <
+                            10**(-3))
+
+            self.assertTrue(abs(inversion.covariance/self.batch[3] -
+                                1).max() < 10**(-3))
+
+    def test_empty(self):
+
+        inversion = self._append(5)
+
+        parameters = numpy.copy(inversion.parameters)
+
+        inversion.append([], [])
+
+        self.assertEqual(inversion.ndata, len(self.depths))
+
+        self.assertTrue((inversion.parameters == parameters).all())
+
+        self.assertTrue((inversion.depths == self.depths).all())
+
+
+if __name__ == '__main__':
+
+    unittest.main()